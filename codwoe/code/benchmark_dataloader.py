@@ -0,0 +1,113 @@
+import argparse
+import logging
+import pathlib
+import sys
+import time
+
+import torch
+
+import data
+
+logger = logging.getLogger(pathlib.Path(__file__).name)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(
+    logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+)
+logger.addHandler(handler)
+
+
+def get_parser(
+    parser=argparse.ArgumentParser(
+        description="benchmark how long training loops wait for batches"
+    ),
+):
+    parser.add_argument(
+        "--train_file", type=pathlib.Path, required=True, help="path to the train file"
+    )
+    parser.add_argument(
+        "--spm_model_path",
+        type=pathlib.Path,
+        default=None,
+        help="path to save or use an existing SentencePiece model, if applicable",
+    )
+    parser.add_argument(
+        "--save_dir",
+        type=pathlib.Path,
+        default=pathlib.Path("models") / "dataloader-benchmark",
+        help="where to cache the packed dataset",
+    )
+    parser.add_argument(
+        "--source_arch",
+        type=str,
+        nargs="+",
+        default=["sgns"],
+        choices=("sgns", "char", "electra"),
+        help="embedding architectures included in batches",
+    )
+    parser.add_argument(
+        "--device",
+        type=torch.device,
+        default=torch.device("cpu"),
+        help="device batches are copied to",
+    )
+    parser.add_argument(
+        "--epochs", type=int, default=3, help="number of passes over the dataset"
+    )
+    parser.add_argument(
+        "--step_time",
+        type=float,
+        default=0.0,
+        help="seconds of simulated computation per batch",
+    )
+    data.add_loader_args(parser)
+    parser.add_argument(
+        "--compare_workers",
+        type=int,
+        nargs="+",
+        default=None,
+        help="numbers of worker processes to compare, defaults to --num_workers only",
+    )
+    parser.add_argument(
+        "--output_file",
+        type=pathlib.Path,
+        default=pathlib.Path("benchmarks") / "dataloader.tsv",
+        help="where to save the stall time of every epoch",
+    )
+    return parser
+
+
+def main(args):
+    args.save_dir.mkdir(parents=True, exist_ok=True)
+    train_dataset = data.get_train_dataset(
+        args.train_file, args.spm_model_path, args.save_dir
+    )
+    results = []
+    for num_workers in args.compare_workers or [args.num_workers]:
+        args.num_workers = num_workers
+        dataloader = data.get_dataloader(
+            train_dataset, archs=args.source_arch, **data.get_loader_options(args)
+        )
+        batches = data.StallTimer(dataloader)
+        for epoch in range(args.epochs):
+            start = time.perf_counter()
+            for batch in batches:
+                for key in batch:
+                    if key != "id":
+                        batch[key].to(args.device, non_blocking=True)
+                time.sleep(args.step_time)
+            elapsed = time.perf_counter() - start
+            results.append((num_workers, epoch, batches.stall_time, elapsed))
+            logger.debug(
+                f"{num_workers} workers, epoch {epoch}: waited {batches.stall_time:.2f}s"
+                + f" for batches, out of {elapsed:.2f}s"
+            )
+    args.output_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output_file, "w") as ostr:
+        print("num_workers\tepoch\tstall_seconds\tepoch_seconds", file=ostr)
+        for result in results:
+            print("\t".join(map(str, result)), file=ostr)
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
@@ -0,0 +1,93 @@
+import argparse
+import logging
+import pathlib
+import sys
+
+import check_output
+import defmod_concat
+import models_concat
+import score
+
+logger = logging.getLogger(pathlib.Path(__file__).name)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(
+    logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+)
+logger.addHandler(handler)
+
+
+def get_parser(
+    parser=argparse.ArgumentParser(
+        description="benchmark the decoding strategies of a definition modeling model"
+    ),
+):
+    parser = defmod_concat.get_parser(parser)
+    parser.add_argument(
+        "--strategies",
+        type=str,
+        nargs="+",
+        default=list(models_concat.DECODING_STRATEGIES),
+        choices=models_concat.DECODING_STRATEGIES,
+        help="decoding strategies to benchmark",
+    )
+    parser.add_argument(
+        "--reference_file",
+        type=pathlib.Path,
+        default=None,
+        help="file containing the reference glosses, defaults to the test file",
+    )
+    parser.add_argument(
+        "--benchmark_dir",
+        type=pathlib.Path,
+        default=pathlib.Path("benchmarks") / "defmod-decoding",
+        help="where to save predictions and scores of each strategy",
+    )
+    return parser
+
+
+def main(args):
+    args.benchmark_dir.mkdir(parents=True, exist_ok=True)
+    results = []
+    # references are encoded once for all strategies
+    mover_scorer = score.MoverScorer()
+    for strategy in args.strategies:
+        logger.debug(f"Benchmarking {strategy} decoding")
+        # 1. produce predictions, and measure throughput
+        args.decoding = strategy
+        args.pred_file = args.benchmark_dir / f"defmod_predictions_{strategy}.json"
+        n_tokens, elapsed = defmod_concat.pred(args)
+        # 2. score predictions
+        summary = check_output.main(args.pred_file)
+        score_args = argparse.Namespace(
+            submission_file=args.pred_file,
+            reference_file=args.reference_file or args.test_file,
+            output_file=args.benchmark_dir / f"scores_{strategy}.txt",
+            cache_dir=None,
+            num_workers=args.num_workers,
+        )
+        # wipe file if exists
+        open(score_args.output_file, "w").close()
+        _, moverscore, lemma_bleu, sense_bleu = score.eval_defmod(
+            score_args, summary, mover_scorer=mover_scorer
+        )
+        results.append(
+            (strategy, n_tokens, elapsed, n_tokens / elapsed, moverscore, lemma_bleu, sense_bleu)
+        )
+    # 3. write results.
+    with open(args.benchmark_dir / "benchmark.tsv", "w") as ostr:
+        print(
+            "strategy\ttokens\tseconds\ttokens_per_second\tMoverScore\tBLEU_lemma\tBLEU_sense",
+            file=ostr,
+        )
+        for result in results:
+            print("\t".join(map(str, result)), file=ostr)
+    for result in results:
+        logger.debug(
+            f"{result[0]}: {result[3]:.1f} tokens/s, MvSc. {result[4]:.4f}, "
+            + f"L-BLEU {result[5]:.4f}, S-BLEU {result[6]:.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
@@ -6,11 +6,12 @@
 
 import argparse  # For handling command-line arguments
 import collections  # For creating named tuple structures
-import json  # For loading JSON data
 import logging  # For setting up logging functionality
 import pathlib  # For handling file paths
 import sys  # For interacting with the system for inputs/outputs
 
+import jsonstream  # For reading submissions one item at a time
+
 # Set up a logger for the script to output debug and error information
 logger = logging.getLogger(pathlib.Path(__file__).name)
 logger.setLevel(logging.DEBUG)  # Set the logging level to DEBUG for detailed information
@@ -30,110 +31,139 @@ def get_parser(
     parser.add_argument("submission_file", type=pathlib.Path, help="file to check")
     return parser
 
-# Main function to verify the submission file
-def main(filename):
+# Keys of revdict items that are not predicted vectors
+NON_VECTOR_KEYS = {
+    "id",
+    "gloss",
+    "word",
+    "pos",
+    "concrete",
+    "example",
+    "f_rnk",
+    "counts",
+    "polysemous",
+}
+
+
+# Largest number of items in a submission, which bounds the memory used to
+# check serial numbers
+MAX_ITEMS = 10 ** 7
+
+
+# Iterate over the items of a submission, one at a time
+def iter_items(filename):
     try:
-        # Attempt to open and load the JSON file
-        with open(filename, "r") as istr:
-            items = json.load(istr)
-        print(f"File '{filename}' successfully loaded. Found {len(items)} items.")
-    except Exception as e:
-        # If the file cannot be opened, raise a ValueError
+        for item in jsonstream.iter_json_array(filename):
+            yield item
+    except (OSError, ValueError) as e:
+        # If the file cannot be opened or parsed, raise a ValueError
         print(f"Error: {e}")
         raise ValueError(f'File "{filename}": could not open, submission will fail.')
-    else:
-        for item in items:
-            # Check if each item contains an "id" key
-            if "id" not in item:
-                raise ValueError(
-                    f'File "{filename}": one or more items do not contain an id, submission will fail.'
-                )
-        # Extract and sort item IDs
-        ids = sorted([item["id"] for item in items])
-        print(f"Extracted IDs: {ids}")
-        ids = [i.split(".") for i in ids]  # Split IDs by periods to process further
-        langs = {i[0] for i in ids}  # Extract the language from the first part of the ID
-        print(f"Languages found: {langs}")
-        if len(langs) != 1:
-            raise ValueError(
-                f'File "{filename}": ids do not identify a unique language, submission will fail.'
-            )
-        tracks = {i[-2] for i in ids}  # Extract the track from the second-to-last part of the ID
-        print(f"Tracks found: {tracks}")
-        if len(tracks) != 1:
+
+
+# Main function to verify the submission file
+def main(filename):
+    # All checks are made in a single pass over the items, so that only the
+    # current item is held in memory
+    n_items = 0
+    lang, track = None, None
+    vec_dims = None
+    # seen_serials[serial] is 1 once an item with this serial number was read
+    seen_serials = bytearray()
+    n_serials = 0
+    for item in iter_items(filename):
+        n_items += 1
+        # Check if each item contains an "id" key
+        if not isinstance(item, dict) or "id" not in item:
             raise ValueError(
-                f'File "{filename}": ids do not identify a unique track, submission will fail.'
+                f'File "{filename}": one or more items do not contain an id, submission will fail.'
             )
-        track = next(iter(tracks))
-        print(f"Track identified: {track}")
-        if track not in ("revdict", "defmod"):
+        # Ids are split by periods once: language, ..., track, serial number
+        id_parts = str(item["id"]).split(".")
+        if lang is None:
+            lang, track = id_parts[0], id_parts[-2] if len(id_parts) > 1 else None
+        if id_parts[0] != lang:
             raise ValueError(
-                f'File "{filename}": unknown track identified {track}, submission will fail.'
+                f'File "{filename}": ids do not identify a unique language, submission will fail.'
             )
-        lang = next(iter(langs))
-        print(f"Language identified: {lang}")
-        if lang not in ("en", "es", "fr", "it", "ru"):
+        if len(id_parts) < 2 or id_parts[-2] != track:
             raise ValueError(
-                f'File "{filename}": unknown language {lang}, submission will fail.'
+                f'File "{filename}": ids do not identify a unique track, submission will fail.'
             )
-        serials = list(sorted({int(i[-1]) for i in ids}))  # Extract and sort serial numbers
-        print(f"Serial numbers found: {serials}")
-        if serials != list(range(1, len(ids) + 1)):
+        if n_items == 1:
+            if track not in ("revdict", "defmod"):
+                raise ValueError(
+                    f'File "{filename}": unknown track identified {track}, submission will fail.'
+                )
+            if lang not in ("en", "es", "fr", "it", "ru"):
+                raise ValueError(
+                    f'File "{filename}": unknown language {lang}, submission will fail.'
+                )
+        try:
+            serial = int(id_parts[-1])
+        except ValueError:
+            serial = 0
+        if serial < 1 or serial > MAX_ITEMS:
             raise ValueError(
                 f'File "{filename}": ids do not identify all items in dataset, submission will fail.'
             )
+        if serial > len(seen_serials):
+            seen_serials.extend(bytes(max(serial, 2 * len(seen_serials)) - len(seen_serials)))
+        n_serials += not seen_serials[serial - 1]
+        seen_serials[serial - 1] = 1
         if track == "revdict":
-            # Extract vector architectures for "revdict" track
-            vec_archs = set(items[0].keys()) - {
-                "id",
-                "gloss",
-                "word",
-                "pos",
-                "concrete",
-                "example",
-                "f_rnk",
-                "counts",
-                "polysemous",
-            }
-            print(f"Vector architectures found: {vec_archs}")
-            if len(vec_archs) == 0:
-                raise ValueError(
-                    f'File "{filename}": no vector architecture was found, revdict submission will fail.'
-                )
-            for item in items:
-                if not all(v in item for v in vec_archs):
+            if vec_dims is None:
+                # Vector architectures and their dimensions are those of the first item
+                vec_archs = set(item.keys()) - NON_VECTOR_KEYS
+                if len(vec_archs) == 0:
+                    raise ValueError(
+                        f'File "{filename}": no vector architecture was found, revdict submission will fail.'
+                    )
+                if len(vec_archs - {"sgns", "char", "electra"}):
+                    raise ValueError(
+                        f'File "{filename}": unknown vector architecture(s), revdict submission will fail.'
+                    )
+                vec_dims = {arch: len(item[arch]) for arch in sorted(vec_archs)}
+            for arch, dim in vec_dims.items():
+                if arch not in item:
                     raise ValueError(
                         f'File "{filename}": some items do not contain all the expected vectors, revdict submission will fail.'
                     )
-            if len(vec_archs - {"sgns", "char", "electra"}):
-                raise ValueError(
-                    f'File "{filename}": unknown vector architecture(s), revdict submission will fail.'
-                )
-        if track == "defmod" and any("gloss" not in i for i in items):
+                if not isinstance(item[arch], list) or len(item[arch]) != dim or dim == 0:
+                    raise ValueError(
+                        f'File "{filename}": {arch} vectors do not all have the same dimension, revdict submission will fail.'
+                    )
+        if track == "defmod" and "gloss" not in item:
             raise ValueError(
                 f'File "{filename}": some items do not contain a gloss, defmod submission will fail.'
             )
-
-        # Compose a success message if all checks pass
-        ok_message = (
-            f'File "{filename}": no problems were identified.\n'
-            + f"The submission will be understood as follows:\n"
-            + f"\tSubmission on track {track} for language {lang}, {len(ids)} predictions.\n"
-        )
-        if track == "revdict":
-            vec_archs = tuple(sorted(vec_archs))
-            ok_message += (
-                f'\tSubmission predicts these embeddings: {", ".join(vec_archs)}.'
-            )
-        else:
-            vec_archs = None
-        logger.debug(ok_message)  # Log the success message
-        print(ok_message)  # Print the success message to the console
-        # Create a summary of the checks
-        CheckSummary = collections.namedtuple(
-            "CheckSummary", ["filename", "track", "lang", "vec_archs"]
+    if n_items == 0:
+        raise ValueError(f'File "{filename}": no items were found, submission will fail.')
+    # Serial numbers must be 1 to the number of items, each appearing once
+    if n_serials != n_items or any(seen_serials[n_items:]):
+        raise ValueError(
+            f'File "{filename}": ids do not identify all items in dataset, submission will fail.'
         )
-        return CheckSummary(filename, track, lang, vec_archs)
+
+    # Compose a compact success message if all checks pass
+    ok_message = (
+        f'File "{filename}": no problems were identified.\n'
+        + f"The submission will be understood as follows:\n"
+        + f"\tSubmission on track {track} for language {lang}, {n_items} predictions.\n"
+    )
+    if track == "revdict":
+        vec_archs = tuple(vec_dims)
+        ok_message += f"\tSubmission predicts these embeddings: " + ", ".join(
+            f"{arch} ({dim} dimensions)" for arch, dim in vec_dims.items()
+        ) + "."
+    else:
+        vec_archs = None
+    logger.debug(ok_message)  # Log the success message
+    # Create a summary of the checks
+    CheckSummary = collections.namedtuple(
+        "CheckSummary", ["filename", "track", "lang", "vec_archs"]
+    )
+    return CheckSummary(filename, track, lang, vec_archs)
 
 # Entry point of the script
 if __name__ == "__main__":
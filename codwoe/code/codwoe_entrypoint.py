@@ -8,6 +8,7 @@
 # Importing necessary modules for each functionality
 import defmod  # Module for definition modeling
 import revdict  # Module for reverse dictionary tasks
+import revdict_index  # Module for looking up the words closest to revdict predictions
 import check_output  # Module for verifying submission file formats
 import score  # Module for evaluating submissions
 
@@ -36,6 +37,13 @@ if __name__ == "__main__":
         )
     )
 
+    # Adding "revdict-index" subcommand for looking up words from revdict predictions
+    parser_revdict_index = revdict_index.get_parser(
+        parser=subparsers.add_parser(
+            "revdict-index", help="look up the words closest to reverse dictionary predictions"
+        )
+    )
+
     # Adding "check-format" subcommand for verifying submission file formats
     parser_check_output = check_output.get_parser(
         parser=subparsers.add_parser(
@@ -59,6 +67,9 @@ if __name__ == "__main__":
     elif args.command == "revdict":
         print("Running reverse dictionary baseline...")
         revdict.main(args)  # Call the main function from the revdict module
+    elif args.command == "revdict-index":
+        print("Looking up reverse dictionary predictions...")
+        revdict_index.main(args)  # Call the main function from the revdict_index module
     elif args.command == "check-format":
         print("Checking the format of the submission file...")
         check_output.main(args.submission_file)  # Call the main function from the check_output module
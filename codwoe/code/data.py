@@ -1,15 +1,29 @@
 from collections import defaultdict
-from itertools import count
+from itertools import chain, count
 import json
+import multiprocessing
+import os
+import pathlib
 import random
 import tempfile
+import time
+
+import numpy as np
 
 import torch
-from torch.nn.utils.rnn import pad_sequence
-from torch.utils.data import DataLoader, Dataset, Sampler
+from torch.utils.data import (
+    BatchSampler,
+    DataLoader,
+    Dataset,
+    RandomSampler,
+    Sampler,
+    SequentialSampler,
+)
 
 import sentencepiece as spm
 
+import jsonstream
+
 BOS = "<seq>"
 EOS = "</seq>"
 PAD = "<pad/>"
@@ -17,8 +31,283 @@ UNK = "<unk/>"
 
 SUPPORTED_ARCHS = ("sgns", "char")
 
+class PackedDataset(Dataset):
+    """A CODWOE dataset stored column-wise: gloss token ids are concatenated into
+    a single array, and each embedding architecture is a single float32 matrix.
+    Once saved, a PackedDataset is loaded as memory-mapped arrays."""
+
+    def __init__(
+        self,
+        ids,
+        itos,
+        gloss_ids=None,
+        gloss_offsets=None,
+        vectors=None,
+        spm_model=None,
+    ):
+        """
+        args: `ids` the id of each item
+              `itos` the vocabulary, as a list of strings
+              `gloss_ids` the concatenated token ids of all glosses, if any
+              `gloss_offsets` where each gloss starts and ends in `gloss_ids`, shape [N + 1]
+              `vectors` a dictionary mapping embedding architectures to matrices of shape [N x dim]
+              `spm_model` the sentencepiece model used to tokenize glosses, if any
+        """
+        self.ids = ids
+        self.itos = itos
+        self.vocab = {word: idx for idx, word in enumerate(itos)}
+        self.gloss_ids = gloss_ids
+        self.gloss_offsets = gloss_offsets
+        self.vectors = vectors or {}
+        self.spm_model = spm_model
+        self.use_spm = spm_model is not None
+        self.has_gloss = gloss_ids is not None
+        self.has_vecs = SUPPORTED_ARCHS[0] in self.vectors
+        self.has_electra = "electra" in self.vectors
+        # the directory this dataset was loaded from, if any
+        self.path = None
+        # concatenated embedding matrices, see `source_matrix`
+        self._sources = {}
+
+    @classmethod
+    def from_json_dataset(cls, dataset):
+        """Convert a JSONDataset pickled by previous versions into columns"""
+        items = dataset.items
+        gloss_ids, gloss_offsets = None, None
+        if dataset.has_gloss:
+            gloss_offsets = np.zeros(len(items) + 1, dtype=np.int64)
+            np.cumsum([item["gloss_tensor"].numel() for item in items], out=gloss_offsets[1:])
+            gloss_ids = torch.cat([item["gloss_tensor"] for item in items]).numpy().astype(np.int32)
+        vectors = {
+            arch: torch.stack([item[f"{arch}_tensor"] for item in items]).numpy().astype(np.float32)
+            for arch in (*SUPPORTED_ARCHS, "electra")
+            if f"{arch}_tensor" in items[0]
+        }
+        return cls(
+            [item["id"] for item in items],
+            dataset.itos,
+            gloss_ids=gloss_ids,
+            gloss_offsets=gloss_offsets,
+            vectors=vectors,
+            spm_model=dataset.spm_model if dataset.use_spm else None,
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        item = {"id": self.ids[index]}
+        if self.has_gloss:
+            start, end = self.gloss_offsets[index], self.gloss_offsets[index + 1]
+            item["gloss_tensor"] = torch.tensor(self.gloss_ids[start:end], dtype=torch.long)
+        for arch, matrix in self.vectors.items():
+            item[f"{arch}_tensor"] = torch.tensor(matrix[index])
+        return item
+
+    # we're adding this method to simplify the code in our predictions of
+    # glosses
+    @torch.no_grad()
+    def decode(self, tensor):
+        """Convert a sequence of indices (possibly batched) to tokens"""
+        if tensor.dim() == 2:
+            # we have batched tensors of shape [Seq x Batch]
+            decoded = []
+            for tensor_ in tensor.t():
+                decoded.append(self.decode(tensor_))
+            return decoded
+        else:
+            ids = [i.item() for i in tensor if i != self.vocab[PAD]]
+            if self.itos[ids[0]] == BOS: ids = ids[1:]
+            if self.itos[ids[-1]] == EOS: ids = ids[:-1]
+            if self.use_spm:
+                return self.spm_model.decode(ids)
+            return " ".join(self.itos[i] for i in ids)
+
+    def save(self, path):
+        """Write columns as .npy files in directory `path`"""
+        path = pathlib.Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        if self.has_gloss:
+            np.save(path / "gloss_ids.npy", self.gloss_ids)
+            np.save(path / "gloss_offsets.npy", self.gloss_offsets)
+        for arch, matrix in self.vectors.items():
+            np.save(path / f"{arch}.npy", matrix)
+        if self.use_spm:
+            (path / "spm.model").write_bytes(self.spm_model.serialized_model_proto())
+        # metadata is written last: a directory without it is an incomplete save
+        with open(path / "meta.json", "w") as ostr:
+            json.dump({"ids": self.ids, "itos": self.itos, "archs": list(self.vectors)}, ostr)
+
+    def source_matrix(self, archs, normalize=False):
+        """The embeddings of `archs` concatenated into a single matrix of shape
+        [N x sum of dims], optionally L2-normalizing each architecture first.
+        For saved datasets, the matrix is written next to the columns once per
+        list of architectures, then memory-mapped.
+        """
+        archs = list(archs)
+        key = "_".join(archs) + ("-normalized" if normalize else "")
+        if key in self._sources:
+            return self._sources[key]
+        file = None if self.path is None else self.path / f"source-{key}.npy"
+        if file is None or not file.is_file():
+            shape = (len(self), sum(self.vectors[arch].shape[-1] for arch in archs))
+            if file is None:
+                matrix = np.empty(shape, dtype=np.float32)
+            else:
+                # written under a temporary name, so that concurrent trials never
+                # read a partial matrix
+                temp_file = file.with_suffix(f".{os.getpid()}.tmp")
+                matrix = np.lib.format.open_memmap(temp_file, mode="w+", dtype=np.float32, shape=shape)
+            for start in range(0, len(self), _ROWS_PER_CHUNK):
+                end = start + _ROWS_PER_CHUNK
+                blocks = [np.asarray(self.vectors[arch][start:end], dtype=np.float32) for arch in archs]
+                if normalize:
+                    blocks = [
+                        block / np.maximum(np.linalg.norm(block, axis=-1, keepdims=True), 1e-12)
+                        for block in blocks
+                    ]
+                matrix[start:end] = np.concatenate(blocks, axis=-1)
+            if file is not None:
+                matrix.flush()
+                del matrix
+                os.replace(temp_file, file)
+        if file is not None:
+            matrix = np.load(file, mmap_mode="r")
+        self._sources[key] = matrix
+        return matrix
+
+    @staticmethod
+    def is_saved(path):
+        return (pathlib.Path(path) / "meta.json").is_file()
+
+    @classmethod
+    def load(cls, path):
+        """Open the columns saved in directory `path` as memory-mapped arrays"""
+        path = pathlib.Path(path)
+        with open(path / "meta.json", "r") as istr:
+            meta = json.load(istr)
+        gloss_ids, gloss_offsets = None, None
+        if (path / "gloss_ids.npy").is_file():
+            gloss_ids = np.load(path / "gloss_ids.npy", mmap_mode="r")
+            gloss_offsets = np.load(path / "gloss_offsets.npy", mmap_mode="r")
+        vectors = {
+            arch: np.load(path / f"{arch}.npy", mmap_mode="r") for arch in meta["archs"]
+        }
+        spm_model = None
+        if (path / "spm.model").is_file():
+            spm_model = spm.SentencePieceProcessor(
+                model_proto=(path / "spm.model").read_bytes()
+            )
+        dataset = cls(
+            meta["ids"],
+            meta["itos"],
+            gloss_ids=gloss_ids,
+            gloss_offsets=gloss_offsets,
+            vectors=vectors,
+            spm_model=spm_model,
+        )
+        dataset.path = path
+        return dataset
+
+    # memory-mapped datasets are reopened rather than copied when pickled, e.g.
+    # when sent to dataloader worker processes
+    def __getstate__(self):
+        if getattr(self, "path", None) is None:
+            return self.__dict__
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        if list(state) == ["path"]:
+            state = vars(self.load(state["path"]))
+        self.__dict__.update(state)
+
+
+# number of items whose embeddings are converted to arrays at once
+_ROWS_PER_CHUNK = 1024
+
+
+def _write_rows(vectors, rows, end):
+    """Convert the buffered `rows` of each architecture with a single call to
+    numpy, and write them into `vectors` up to index `end`, growing them if needed"""
+    for arch, matrix in vectors.items():
+        if len(matrix) < end:
+            matrix.resize((max(end, 2 * len(matrix)), matrix.shape[1]), refcheck=False)
+        if rows[arch]:
+            matrix[end - len(rows[arch]) : end] = np.asarray(rows[arch], dtype=np.float32)
+        rows[arch].clear()
+
+
+def _init_spm_worker(model_proto):
+    global _worker_spm_model
+    _worker_spm_model = spm.SentencePieceProcessor(model_proto=model_proto)
+
+
+def _encode_in_worker(glosses):
+    return _worker_spm_model.encode(glosses, add_eos=True, add_bos=True)
+
+
+def _encode_with_spm(spm_model, glosses, num_workers=1):
+    """Encode all glosses in one sentencepiece batch call, or one per worker process.
+    Returns the concatenated token ids and the number of tokens per gloss."""
+    if num_workers > 1 and len(glosses) > num_workers:
+        chunk_size = -(-len(glosses) // num_workers)
+        chunks = [
+            glosses[start : start + chunk_size]
+            for start in range(0, len(glosses), chunk_size)
+        ]
+        with multiprocessing.Pool(
+            num_workers,
+            initializer=_init_spm_worker,
+            initargs=(spm_model.serialized_model_proto(),),
+        ) as pool:
+            encoded = list(chain.from_iterable(pool.map(_encode_in_worker, chunks)))
+    else:
+        encoded = spm_model.encode(glosses, add_eos=True, add_bos=True)
+    lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+    token_ids = np.fromiter(
+        chain.from_iterable(encoded), dtype=np.int32, count=lengths.sum()
+    )
+    return token_ids, lengths
+
+
+def _encode_with_vocab(glosses, vocab, bos, eos, unk, freeze_vocab):
+    """Split glosses on whitespace and look up each distinct word only once.
+    Returns the concatenated token ids and the number of tokens per gloss."""
+    words = [gloss.split() for gloss in glosses]
+    n_words = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    words = np.array(list(chain.from_iterable(words)), dtype=object)
+    distinct, first_seen, inverse = np.unique(
+        words, return_index=True, return_inverse=True
+    )
+    if not freeze_vocab:
+        # new words are indexed in order of first appearance
+        for word in distinct[np.argsort(first_seen, kind="stable")]:
+            vocab[word]
+    word_ids = np.array([vocab.get(word, unk) for word in distinct], dtype=np.int32)
+    # each gloss is framed by BOS and EOS
+    lengths = n_words + 2
+    ends = np.cumsum(lengths)
+    token_ids = np.empty(ends[-1] if len(ends) else 0, dtype=np.int32)
+    is_word = np.ones(len(token_ids), dtype=bool)
+    token_ids[ends - lengths], is_word[ends - lengths] = bos, False
+    token_ids[ends - 1], is_word[ends - 1] = eos, False
+    token_ids[is_word] = word_ids[inverse.reshape(-1)]
+    return token_ids, lengths
+
+
+def _truncate_glosses(token_ids, lengths, maxlen):
+    """Keep the first `maxlen` tokens of each gloss, and compute gloss offsets"""
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    if maxlen:
+        positions = np.arange(len(token_ids)) - np.repeat(offsets[:-1], lengths)
+        token_ids = token_ids[positions < maxlen]
+        np.cumsum(np.minimum(lengths, maxlen), out=offsets[1:])
+    return token_ids, offsets
+
+
 # A dataset is a container object for the actual data
-class JSONDataset(Dataset):
+class JSONDataset(PackedDataset):
     """Reads a CODWOE JSON dataset"""
 
     def __init__(
@@ -29,36 +318,65 @@ class JSONDataset(Dataset):
         maxlen=256,
         spm_model_name=None,
         train_spm=False,
+        num_workers=1,
     ):
         """
         Construct a torch.utils.data.Dataset compatible with torch data API and
         codwoe data.
+        Items are parsed one at a time and their embeddings are written directly
+        into packed arrays, so that memory use stays close to the final size of
+        the dataset.
         args: `file` the path to the dataset file
               `vocab` a dictionary mapping strings to indices
               `freeze_vocab` whether to update vocabulary, or just replace unknown items with OOV token
               `maxlen` the maximum number of tokens per gloss
               `spm_model_name` create and use this sentencepiece model instead of whitespace tokenization
+              `train_spm` whether to train the sentencepiece model first
+              `num_workers` the number of processes encoding glosses with sentencepiece
         """
-        self.use_spm = spm_model_name is not None
+        use_spm = spm_model_name is not None
         if vocab is None:
-            self.vocab = defaultdict(count().__next__)
+            vocab_ = defaultdict(count().__next__)
         else:
-            self.vocab = defaultdict(count(len(vocab)).__next__)
-            self.vocab.update(vocab)
+            vocab_ = defaultdict(count(len(vocab)).__next__)
+            vocab_.update(vocab)
         pad, eos, bos, unk = (
-            self.vocab[PAD],
-            self.vocab[EOS],
-            self.vocab[BOS],
-            self.vocab[UNK],
+            vocab_[PAD],
+            vocab_[EOS],
+            vocab_[BOS],
+            vocab_[UNK],
         )
         if freeze_vocab:
-            self.vocab = dict(vocab)
-        with open(file, "r") as istr:
-            self.items = json.load(istr)
-        if self.use_spm:
+            vocab_ = dict(vocab)
+        # stream items: only glosses are kept as strings, until they are tokenized
+        ids, glosses, vectors, rows = [], [], {}, {}
+        has_gloss = False
+        for json_dict in jsonstream.iter_json_array(file):
+            if not ids:
+                # in definition modeling test datasets, gloss targets are absent;
+                # in reverse dictionary test datasets, vector targets are absent
+                has_gloss = "gloss" in json_dict
+                vectors = {
+                    arch: np.empty((_ROWS_PER_CHUNK, len(json_dict[arch])), dtype=np.float32)
+                    for arch in (*SUPPORTED_ARCHS, "electra")
+                    if arch in json_dict
+                }
+                rows = {arch: [] for arch in vectors}
+            for arch in vectors:
+                rows[arch].append(json_dict[arch])
+            if has_gloss:
+                glosses.append(json_dict["gloss"])
+            ids.append(json_dict["id"])
+            if len(ids) % _ROWS_PER_CHUNK == 0:
+                _write_rows(vectors, rows, len(ids))
+        _write_rows(vectors, rows, len(ids))
+        for matrix in vectors.values():
+            matrix.resize((len(ids), matrix.shape[1]), refcheck=False)
+        spm_model = None
+        if use_spm:
             if train_spm:
                 with tempfile.NamedTemporaryFile(mode="w+") as temp_fp:
-                    for gls in (j["gloss"] for j in self.items):
+                    for gls in glosses:
                         print(gls, file=temp_fp)
                     temp_fp.seek(0)
                     spm.SentencePieceTrainer.train(
@@ -74,165 +392,241 @@ class JSONDataset(Dataset):
                         unk_id=unk,
                         unk_piece=UNK,
                     )
-            self.spm_model = spm.SentencePieceProcessor(
+            spm_model = spm.SentencePieceProcessor(
                 model_file=f"{spm_model_name}.model"
             )
-        # preparse data
-        for json_dict in self.items:
-            # in definition modeling test datasets, gloss targets are absent
-            if "gloss" in json_dict:
-                if spm_model_name:
-                    json_dict["gloss_tensor"] = torch.tensor(
-                        self.spm_model.encode(
-                            json_dict["gloss"], add_eos=True, add_bos=True
-                        )
-                    )
-                else:
-                    json_dict["gloss_tensor"] = torch.tensor(
-                        [bos]
-                        + [
-                            self.vocab[word]
-                            if not freeze_vocab
-                            else self.vocab.get(word, unk)
-                            for word in json_dict["gloss"].split()
-                        ]
-                        + [eos]
-                    )
-                if maxlen:
-                    json_dict["gloss_tensor"] = json_dict["gloss_tensor"][:maxlen]
-            # in reverse dictionary test datasets, vector targets are absent
-            for arch in SUPPORTED_ARCHS:
-                if arch in json_dict:
-                    json_dict[f"{arch}_tensor"] = torch.tensor(json_dict[arch])
-            if "electra" in json_dict:
-                json_dict["electra_tensor"] = torch.tensor(json_dict["electra"])
-        if self.use_spm:
-            self.vocab = {
-                self.spm_model.id_to_piece(idx): idx
-                for idx in range(self.spm_model.get_piece_size())
-            }
-
-        self.has_gloss = "gloss" in self.items[0]
-        self.has_vecs = SUPPORTED_ARCHS[0] in self.items[0]
-        self.has_electra = "electra" in self.items[0]
-        self.itos = sorted(self.vocab, key=lambda w: self.vocab[w])
-
-    def __len__(self):
-        return len(self.items)
-
-    def __getitem__(self, index):
-        return self.items[index]
-
-    # we're adding this method to simplify the code in our predictions of
-    # glosses
-    @torch.no_grad()
-    def decode(self, tensor):
-        """Convert a sequence of indices (possibly batched) to tokens"""
-        if tensor.dim() == 2:
-            # we have batched tensors of shape [Seq x Batch]
-            decoded = []
-            for tensor_ in tensor.t():
-                decoded.append(self.decode(tensor_))
-            return decoded
+        # preparse glosses
+        gloss_ids, gloss_offsets = None, None
+        if has_gloss:
+            if use_spm:
+                gloss_ids, lengths = _encode_with_spm(spm_model, glosses, num_workers)
+            else:
+                gloss_ids, lengths = _encode_with_vocab(
+                    glosses, vocab_, bos, eos, unk, freeze_vocab
+                )
+            del glosses
+            gloss_ids, gloss_offsets = _truncate_glosses(gloss_ids, lengths, maxlen)
+        if use_spm:
+            itos = [
+                spm_model.id_to_piece(idx) for idx in range(spm_model.get_piece_size())
+            ]
         else:
-            ids = [i.item() for i in tensor if i != self.vocab[PAD]]
-            if self.itos[ids[0]] == BOS: ids = ids[1:]
-            if self.itos[ids[-1]] == EOS: ids = ids[:-1]
-            if self.use_spm:
-                return self.spm_model.decode(ids)
-            return " ".join(self.itos[i] for i in ids)
-
-    def save(self, file):
-        torch.save(self, file)
-
-    @staticmethod
-    def load(file):
-        return torch.load(file)
+            itos = sorted(vocab_, key=lambda w: vocab_[w])
+        super().__init__(
+            ids,
+            itos,
+            gloss_ids=gloss_ids,
+            gloss_offsets=gloss_offsets,
+            vectors=vectors,
+            spm_model=spm_model,
+        )
 
 
 # A sampler allows you to define how to select items from your Dataset. Torch
 # provides a number of default Sampler classes
 class TokenSampler(Sampler):
-    """Produce batches with up to `batch_size` tokens in each batch"""
+    """Produce batches with up to `batch_size` tokens in each batch.
+    Items are split into pools and sorted by size within each pool, so that
+    items batched together have similar sizes and little padding is needed."""
 
     def __init__(
-        self, dataset, batch_size=150, size_fn=len, drop_last=False, shuffle=True
+        self,
+        dataset,
+        batch_size=150,
+        size_fn=len,
+        drop_last=False,
+        shuffle=True,
+        pool_size=4096,
+        sizes=None,
     ):
         """
         args: `dataset` a torch.utils.data.Dataset (iterable style)
               `batch_size` the maximum number of tokens in a batch
               `size_fn` a callable that yields the number of tokens in a dataset item
               `drop_last` if True and the data can't be divided in exactly the right number of batch, drop the last batch
-              `shuffle` if True, shuffle between every iteration
+              `shuffle` if True, shuffle items before pooling them and shuffle batches, between every iteration
+              `pool_size` the number of items sorted together
+              `sizes` the number of tokens of each dataset item, computed with `size_fn` if not given
         """
         self.dataset = dataset
         self.batch_size = batch_size
         self.size_fn = size_fn
+        if sizes is None:
+            sizes = [size_fn(dataset[i]) for i in range(len(dataset))]
+        self.sizes = np.asarray(sizes, dtype=np.int64)
         self._len = None
         self.drop_last = drop_last
-        self.shuffle = True
+        self.shuffle = shuffle
+        self.pool_size = pool_size
+        # ratio of actual tokens to padded tokens, over the batches of the last iteration
+        self.padding_efficiency = None
 
-    def __iter__(self):
-        indices = range(len(self.dataset))
+    def make_batches(self):
+        """Split the dataset into lists of indices, one per batch"""
         if self.shuffle:
-            indices = list(indices)
-            random.shuffle(indices)
-        i = 0
+            indices = np.random.permutation(len(self.sizes))
+        else:
+            indices = np.arange(len(self.sizes))
+        batches = []
         selected = []
         numel = 0
-        longest_len = 0
-        for i in indices:
-            if numel + self.size_fn(self.dataset[i]) > self.batch_size:
-                if selected:
-                    yield selected
-                selected = []
-                numel = 0
-            numel += self.size_fn(self.dataset[i])
-            selected.append(i)
-        if selected and not self.drop_last:
-            yield selected
+        for start in range(0, len(indices), self.pool_size):
+            pool = indices[start : start + self.pool_size]
+            pool = pool[np.argsort(self.sizes[pool], kind="stable")]
+            for i, size in zip(pool.tolist(), self.sizes[pool].tolist()):
+                if numel + size > self.batch_size:
+                    if selected:
+                        batches.append(selected)
+                    selected = []
+                    numel = 0
+                numel += size
+                selected.append(i)
+            # batches do not span pools
+            if selected:
+                batches.append(selected)
+            selected = []
+            numel = 0
+        if batches and self.drop_last:
+            batches.pop()
+        if self.shuffle:
+            random.shuffle(batches)
+        if batches:
+            n_padded = sum(len(batch) * self.sizes[batch].max() for batch in batches)
+            n_tokens = sum(self.sizes[batch].sum() for batch in batches)
+            self.padding_efficiency = (n_tokens / n_padded).item()
+        return batches
+
+    def __iter__(self):
+        yield from self.make_batches()
 
     def __len__(self):
         if self._len is None:
-            self._len = round(
-                sum(self.size_fn(self.dataset[i]) for i in range(len(self.dataset)))
-                / self.batch_size
-            )
+            self._len = round(self.sizes.sum().item() / self.batch_size)
         return self._len
 
 
+class PackedBatches(Dataset):
+    """View of a PackedDataset where items are whole batches: indexing it with a
+    list of indices gathers the corresponding rows of each column at once."""
+
+    def __init__(self, dataset, archs=None, concat_archs=False, normalize=False):
+        """
+        args: `dataset` a PackedDataset
+              `archs` the embedding architectures to include in batches, defaults to all
+              `concat_archs` whether to include all `archs` as a single "source_tensor"
+              `normalize` whether to L2-normalize each architecture in "source_tensor"
+        """
+        self.dataset = dataset
+        self.archs = list(dataset.vectors) if archs is None else list(archs)
+        self.concat_archs = concat_archs
+        self.normalize = normalize
+        self.PAD_idx = dataset.vocab[PAD]
+        if concat_archs:
+            # built here rather than in each worker process
+            dataset.source_matrix(self.archs, normalize=normalize)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, indices):
+        """produce a dict batch: ids, padded glosses of shape [Seq x Batch] and
+        embeddings of shape [Batch x Dim]"""
+        indices = np.asarray(indices, dtype=np.int64)
+        batch = {"id": [self.dataset.ids[i] for i in indices.tolist()]}
+        if self.dataset.has_gloss:
+            starts = self.dataset.gloss_offsets[indices]
+            lengths = self.dataset.gloss_offsets[indices + 1] - starts
+            positions = np.arange(lengths.max())[:, None]
+            is_token = positions < lengths[None, :]
+            gloss_tensor = np.full(is_token.shape, self.PAD_idx, dtype=np.int64)
+            gloss_tensor[is_token] = self.dataset.gloss_ids[(starts[None, :] + positions)[is_token]]
+            batch["gloss_tensor"] = torch.from_numpy(gloss_tensor)
+        if self.concat_archs:
+            source = self.dataset.source_matrix(self.archs, normalize=self.normalize)
+            batch["source_tensor"] = torch.from_numpy(np.ascontiguousarray(source[indices]))
+            return batch
+        for arch in self.archs:
+            batch[f"{arch}_tensor"] = torch.from_numpy(
+                np.ascontiguousarray(self.dataset.vectors[arch][indices])
+            )
+        return batch
+
+
+def _make_loader(
+    dataset,
+    batches,
+    archs=None,
+    concat_archs=False,
+    normalize=False,
+    num_workers=0,
+    pin_memory=False,
+    prefetch_factor=2,
+    persistent_workers=False,
+):
+    """the sampler yields lists of indices, which PackedBatches turns into
+    batches directly: there is no per-item collation"""
+    # torch rejects these options without worker processes
+    worker_options = {}
+    if num_workers > 0:
+        worker_options = dict(
+            prefetch_factor=prefetch_factor, persistent_workers=persistent_workers
+        )
+    return DataLoader(
+        PackedBatches(dataset, archs=archs, concat_archs=concat_archs, normalize=normalize),
+        sampler=batches,
+        batch_size=None,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        **worker_options,
+    )
+
+
+class StallTimer:
+    """Iterate over a dataloader, measuring how long each iteration waits for batches"""
+
+    def __init__(self, dataloader):
+        self.dataloader = dataloader
+        # seconds spent waiting for batches during the last iteration
+        self.stall_time = 0.0
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        self.stall_time = 0.0
+        batches = iter(self.dataloader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            finally:
+                self.stall_time += time.perf_counter() - start
+            yield batch
+
+
 # DataLoaders give access to an iterator over the dataset, using a sampling
 # strategy as defined through a Sampler.
-def get_dataloader(dataset, batch_size=200, shuffle=True):
+def get_dataloader(
+    dataset,
+    batch_size=200,
+    shuffle=True,
+    archs=None,
+    concat_archs=False,
+    normalize=False,
+    **loader_options,
+):
     """produce dataloader.
-    args: `dataset` a torch.utils.data.Dataset (iterable style)
+    args: `dataset` a PackedDataset
           `batch_size` the maximum number of tokens in a batch
           `shuffle` if True, shuffle between every iteration
+          `archs` the embedding architectures to include in batches, defaults to all
+          `concat_archs` whether batches contain all `archs` as a single "source_tensor"
+          `normalize` whether to L2-normalize each architecture in "source_tensor"
+          `loader_options` `num_workers`, `pin_memory`, `prefetch_factor` and
+              `persistent_workers`, as for torch.utils.data.DataLoader
     """
-    # some constants for the closures
-    has_gloss = dataset.has_gloss
-    has_vecs = dataset.has_vecs
-    has_electra = dataset.has_electra
-    PAD_idx = dataset.vocab[PAD]
-
-    # the collate function has to convert a list of dataset items into a batch
-    def do_collate(json_dicts):
-        """collates example into a dict batch; produces ands pads tensors"""
-        batch = defaultdict(list)
-        for jdict in json_dicts:
-            for key in jdict:
-                batch[key].append(jdict[key])
-        if has_gloss:
-            batch["gloss_tensor"] = pad_sequence(
-                batch["gloss_tensor"], padding_value=PAD_idx, batch_first=False
-            )
-        if has_vecs:
-            for arch in SUPPORTED_ARCHS:
-                batch[f"{arch}_tensor"] = torch.stack(batch[f"{arch}_tensor"])
-        if has_electra:
-            batch["electra_tensor"] = torch.stack(batch["electra_tensor"])
-        return dict(batch)
-
     if dataset.has_gloss:
         # we try to keep the amount of gloss tokens roughly constant across all
         # batches.
@@ -240,40 +634,135 @@ def get_dataloader(dataset, batch_size=200, shuffle=True):
             """retrieve tensor size, so as to batch items per elements"""
             return item["gloss_tensor"].numel()
 
-        return DataLoader(
+        batches = TokenSampler(
             dataset,
-            collate_fn=do_collate,
-            batch_sampler=TokenSampler(
-                dataset, batch_size=batch_size, size_fn=do_size_item, shuffle=shuffle
-            ),
+            batch_size=batch_size,
+            size_fn=do_size_item,
+            shuffle=shuffle,
+            sizes=np.diff(dataset.gloss_offsets),
         )
     else:
         # there's no gloss, hence no gloss tokens, so we use a default batching
         # strategy.
-        return DataLoader(
-            dataset, collate_fn=do_collate, batch_size=batch_size, shuffle=shuffle
+        batches = BatchSampler(
+            RandomSampler(dataset) if shuffle else SequentialSampler(dataset),
+            batch_size=batch_size,
+            drop_last=False,
         )
+    return _make_loader(
+        dataset,
+        batches,
+        archs=archs,
+        concat_archs=concat_archs,
+        normalize=normalize,
+        **loader_options,
+    )
 
 
-def get_train_dataset(train_file, spm_model_path, save_dir):
-    if (save_dir / "train_dataset.pt").is_file():
-        dataset = JSONDataset.load(save_dir / "train_dataset.pt")
-    else:
-        dataset = JSONDataset(
-            train_file,
-            spm_model_name=spm_model_path.with_suffix(""),
-            train_spm=not spm_model_path.with_suffix(".model").is_file(),
-        )
-        dataset.save(save_dir / "train_dataset.pt")
-    return dataset
+def get_pred_dataloader(
+    dataset,
+    batch_size=16,
+    archs=None,
+    concat_archs=False,
+    normalize=False,
+    **loader_options,
+):
+    """produce dataloader for predictions, with a fixed number of items per batch.
+    args: `dataset` a PackedDataset
+          `batch_size` the number of items in a batch
+          `archs` the embedding architectures to include in batches, defaults to all
+          `concat_archs` whether batches contain all `archs` as a single "source_tensor"
+          `normalize` whether to L2-normalize each architecture in "source_tensor"
+          `loader_options` `num_workers`, `pin_memory`, `prefetch_factor` and
+              `persistent_workers`, as for torch.utils.data.DataLoader
+    Items are batched in dataset order, unless glosses are available: then
+    items with glosses of similar lengths are batched together.
+    """
+    indices = np.arange(len(dataset))
+    if dataset.has_gloss:
+        indices = np.argsort(np.diff(dataset.gloss_offsets), kind="stable")
+    batches = [
+        indices[start : start + batch_size].tolist()
+        for start in range(0, len(indices), batch_size)
+    ]
+    return _make_loader(
+        dataset,
+        batches,
+        archs=archs,
+        concat_archs=concat_archs,
+        normalize=normalize,
+        **loader_options,
+    )
 
 
-def get_dev_dataset(dev_file, spm_model_path, save_dir, train_dataset=None):
-    if (save_dir / "dev_dataset.pt").is_file():
-        dataset = JSONDataset.load(save_dir / "dev_dataset.pt")
-    else:
-        dataset = JSONDataset(
-            dev_file, spm_model_name=spm_model_path, train_spm=False
-        )
-        dataset.save(save_dir / "dev_dataset.pt")
-    return dataset
+def add_loader_args(parser):
+    """add arguments configuring the dataloaders to `parser`"""
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=0,
+        help="number of processes loading batches in the background, and encoding glosses",
+    )
+    parser.add_argument(
+        "--pin_memory",
+        action="store_true",
+        help="whether to load batches in page-locked memory, for faster copies to GPU",
+    )
+    parser.add_argument(
+        "--prefetch_factor",
+        type=int,
+        default=2,
+        help="number of batches loaded in advance by each worker",
+    )
+    parser.add_argument(
+        "--persistent_workers",
+        action="store_true",
+        help="whether to keep worker processes alive between epochs",
+    )
+    return parser
+
+
+def get_loader_options(args):
+    """retrieve the dataloader options added by `add_loader_args` from `args`"""
+    return {
+        "num_workers": args.num_workers,
+        "pin_memory": args.pin_memory,
+        "prefetch_factor": args.prefetch_factor,
+        "persistent_workers": args.persistent_workers,
+    }
+
+
+def get_train_dataset(train_file, spm_model_path, save_dir, num_workers=1):
+    if not PackedDataset.is_saved(save_dir / "train_dataset"):
+        if (save_dir / "train_dataset.pt").is_file():
+            # convert datasets cached by previous versions
+            dataset = PackedDataset.from_json_dataset(
+                torch.load(save_dir / "train_dataset.pt")
+            )
+        else:
+            dataset = JSONDataset(
+                train_file,
+                spm_model_name=spm_model_path.with_suffix(""),
+                train_spm=not spm_model_path.with_suffix(".model").is_file(),
+                num_workers=num_workers,
+            )
+        dataset.save(save_dir / "train_dataset")
+    return PackedDataset.load(save_dir / "train_dataset")
+
+
+def get_dev_dataset(dev_file, spm_model_path, save_dir, train_dataset=None, num_workers=1):
+    if not PackedDataset.is_saved(save_dir / "dev_dataset"):
+        if (save_dir / "dev_dataset.pt").is_file():
+            # convert datasets cached by previous versions
+            dataset = PackedDataset.from_json_dataset(
+                torch.load(save_dir / "dev_dataset.pt")
+            )
+        else:
+            dataset = JSONDataset(
+                dev_file,
+                spm_model_name=spm_model_path,
+                train_spm=False,
+                num_workers=num_workers,
+            )
+        dataset.save(save_dir / "dev_dataset")
+    return PackedDataset.load(save_dir / "dev_dataset")
@@ -12,11 +12,11 @@ import logging  # For logging events and information
 import pathlib  # For handling file paths in a platform-independent way
 import pprint  # For pretty-printing data structures
 import secrets  # For generating secure random numbers or tokens
+import time  # For measuring decoding throughput
 
 import skopt  # For hyperparameter optimization
 
 import torch  # PyTorch library for tensor computation and deep learning
-import torch.nn as nn  # For building neural network layers
 import torch.nn.functional as F  # For functions like activation and loss
 import torch.optim as optim  # For optimization algorithms
 from torch.utils.tensorboard import SummaryWriter  # For logging metrics to TensorBoard
@@ -24,7 +24,9 @@ from torch.utils.tensorboard import SummaryWriter  # For logging metrics to Tens
 import tqdm  # For displaying progress bars during processing
 
 import data  # Custom module for handling datasets
+import htune  # Custom module for parallel hyperparameter search
 import models_concat  # Custom module for defining machine learning models
+import train_utils  # Custom module for mixed precision training
 
 # Logger setup for debugging and progress monitoring
 logger = logging.getLogger(pathlib.Path(__file__).name)  # Get logger for the script
@@ -110,6 +112,54 @@ def get_parser(
         default=pathlib.Path("defmod-baseline-preds.json"),
         help="file to save the generated predictions",
     )
+    # Argument to specify how many test items are decoded together
+    parser.add_argument(
+        "--pred_batch_size",
+        type=int,
+        default=16,
+        help="number of test items to decode at once when producing predictions",
+    )
+    # Arguments to specify how glosses are decoded when producing predictions
+    parser.add_argument(
+        "--decoding",
+        type=str,
+        default="beam",
+        choices=models_concat.DECODING_STRATEGIES,
+        help="decoding strategy used to produce predictions",
+    )
+    parser.add_argument(
+        "--beam_size",
+        type=int,
+        default=64,
+        help="number of beams kept when decoding with beam search",
+    )
+    parser.add_argument(
+        "--top_k",
+        type=int,
+        default=50,
+        help="number of most likely tokens to sample from, for top_k decoding",
+    )
+    parser.add_argument(
+        "--top_p",
+        type=float,
+        default=0.9,
+        help="probability mass of most likely tokens to sample from, for nucleus decoding",
+    )
+    # Arguments to configure background loading of batches
+    data.add_loader_args(parser)
+    # Arguments to train in mixed precision
+    train_utils.add_precision_args(parser)
+    # Argument to specify how often training metrics are logged
+    parser.add_argument(
+        "--log_every",
+        type=int,
+        default=50,
+        help="number of training steps metrics are averaged over before being logged",
+    )
+    # Arguments to checkpoint and resume training
+    train_utils.add_checkpoint_args(parser)
+    # Arguments to configure hyperparameter search
+    htune.add_htune_args(parser)
     # Return the configured argument parser
     return parser
 
@@ -150,9 +200,19 @@ def train(
     label_smoothing=0.1,
     n_head=4,
     n_layers=4,
+    loader_options=None,
+    precision="fp32",
+    precision_tolerance=0.01,
+    log_every=50,
+    checkpoint_every=0,
+    keep_checkpoints=3,
+    resume=False,
+    epoch_callback=None,
+    context=None,
 ):
     assert train_file is not None, "Missing dataset for training"
     assert dev_file is not None, "Missing dataset for development"
+    start_time = time.perf_counter()
 
     # 1. get data, vocabulary, summary writer
     logger.debug("Preloading data")
@@ -160,11 +220,18 @@ def train(
     save_dir = save_dir / "_".join(source_arch)  # JZ
 
     save_dir.mkdir(parents=True, exist_ok=True)
-    ## make datasets
-    train_dataset = data.get_train_dataset(train_file, spm_model_path, save_dir)
-    dev_dataset = data.get_dev_dataset(
-        dev_file, spm_model_path, save_dir, train_dataset
-    )
+    loader_options = loader_options or {}
+    num_workers = loader_options.get("num_workers", 1)
+    ## make datasets, unless a hyperparameter search shares them across trials
+    if context is None:
+        train_dataset = data.get_train_dataset(
+            train_file, spm_model_path, save_dir, num_workers
+        )
+        dev_dataset = data.get_dev_dataset(
+            dev_file, spm_model_path, save_dir, train_dataset, num_workers
+        )
+    else:
+        train_dataset, dev_dataset = context.train_dataset, context.dev_dataset
     ## assert they correspond to the task
     assert train_dataset.has_gloss, "Training dataset contains no gloss."
 
@@ -196,9 +263,14 @@ def train(
             assert dev_dataset.has_vecs, f"Development dataset is missing {arch} embeddings."
     # JZ --end
 
-    ## make dataloader
-    train_dataloader = data.get_dataloader(train_dataset)
-    dev_dataloader = data.get_dataloader(dev_dataset, shuffle=False)
+    ## make dataloader, batches contain all source embeddings in a single tensor
+    train_dataloader = data.get_dataloader(
+        train_dataset, archs=source_arch, concat_archs=True, **loader_options
+    )
+    dev_dataloader = data.get_dataloader(
+        dev_dataset, shuffle=False, archs=source_arch, concat_archs=True, **loader_options
+    )
+    train_batches = data.StallTimer(train_dataloader)
     ## make summary writer
     summary_writer = SummaryWriter(summary_logdir)
     train_step = itertools.count()  # to keep track of the training steps for logging
@@ -212,8 +284,7 @@ def train(
     # )
 
     # Compute total embedding dimension by summing the dimensions of all selected embeddings
-    sample_batch = next(iter(data.get_dataloader(train_dataset)))
-    embedding_dim = sum(sample_batch[f"{arch}_tensor"].shape[-1] for arch in source_arch)
+    embedding_dim = sum(train_dataset.vectors[arch].shape[-1] for arch in source_arch)
 
     model = models_concat.DefmodModel(
         dev_dataset.vocab, input_dim=embedding_dim, n_head=n_head, n_layers=n_layers, dropout=dropout
@@ -231,76 +302,104 @@ def train(
         betas=(beta1, beta2),
         weight_decay=weight_decay,
     )
-    xent_criterion = nn.CrossEntropyLoss(ignore_index=model.padding_idx)
-    if label_smoothing > 0.0:
-        smooth_criterion = models_concat.LabelSmoothingCrossEntropy(
-            ignore_index=model.padding_idx, epsilon=label_smoothing
-        )
-    else:
-        smooth_criterion = xent_criterion
-
-    # JZ  --start--
-    # vec_tensor_key = f"{source_arch}_tensor"
-    vec_tensor_key = [f"{arch}_tensor" for arch in args.source_arch]
-    # JZ  --end--
+    # without label smoothing, the smoothed loss is the cross-entropy; the
+    # criterion also yields the cross-entropy and accuracy used as metrics
+    smooth_criterion = models_concat.FusedLabelSmoothingCrossEntropy(
+        ignore_index=model.padding_idx, epsilon=label_smoothing
+    )
+    train_metrics = train_utils.MetricsAccumulator(
+        summary_writer, "defmod-train", log_every=log_every
+    )
 
     best_xent = float("inf")
     strikes = 0
 
     # 4. train model
-    epochs_range = tqdm.trange(epochs, desc="Epochs")
     total_steps = (len(train_dataloader) * epochs) // batch_accum
     scheduler = models_concat.get_schedule(
         optimizer, round(total_steps * warmup_len), total_steps
     )
+    scaler = train_utils.get_grad_scaler(device, precision)
+    ## resume from the full training state of a previous run, if asked to
+    checkpoints = train_utils.CheckpointManager(
+        save_dir / "checkpoints", keep=keep_checkpoints
+    )
+    start_epoch = 0
+    state = checkpoints.load_latest() if resume else None
+    if state is not None:
+        model.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        scheduler.load_state_dict(state["scheduler"])
+        scaler.load_state_dict(state["scaler"])
+        best_xent, strikes = state["best_xent"], state["strikes"]
+        train_step = itertools.count(state["train_step"])
+        train_utils.set_rng_states(state["rng"])
+        start_epoch = state["epoch"] + 1
+        logger.debug(f"Resuming training from the end of epoch {state['epoch']}")
+    epochs_range = tqdm.trange(start_epoch, epochs, desc="Epochs")
+    # time spent before the first step, including opening shared datasets
+    startup_time = time.perf_counter() - start_time
+    if context is not None:
+        startup_time += context.load_time
+    logger.debug(f"Training set up in {startup_time:.2f}s")
+    summary_writer.add_scalar("defmod-train/startup_time", startup_time, start_epoch)
     for epoch in epochs_range:
         ## train loop
         pbar = tqdm.tqdm(
             desc=f"Train {epoch}", total=len(train_dataset), disable=None, leave=False
         )
         optimizer.zero_grad()
-        for i, batch in enumerate(train_dataloader):
+        for i, batch in enumerate(train_batches):
             # JZ  --start--
             # vec = batch[vec_tensor_key].to(device)
-            vec = torch.cat([batch[key].to(device) for key in vec_tensor_key], dim=-1)
+            vec = batch["source_tensor"].to(device, non_blocking=True)
             # JZ  --end--
             
-            gls = batch["gloss_tensor"].to(device)
-            pred = model(vec, gls[:-1])
-            loss = smooth_criterion(pred.view(-1, pred.size(-1)), gls.view(-1))
-            loss.backward()
+            gls = batch["gloss_tensor"].to(device, non_blocking=True)
+            with train_utils.autocast(device, precision):
+                pred = model(vec, gls[:-1]).float()
+            loss, xent_unsmoothed, acc = smooth_criterion(
+                pred.view(-1, pred.size(-1)), gls.view(-1)
+            )
+            scaler.scale(loss).backward()
             grad_remains = True
             step = next(train_step)
             if i % batch_accum == 0:
-                optimizer.step()
+                scaler.step(optimizer)
+                scaler.update()
                 scheduler.step()
                 optimizer.zero_grad()
                 grad_remains = False
                 summary_writer.add_scalar(
                     "defmod-train/lr", scheduler.get_last_lr()[0], step
                 )
-            # keep track of the train loss for this step
-            with torch.no_grad():
-                tokens = gls != model.padding_idx
-                acc = (
-                    ((pred.argmax(-1) == gls) & tokens).float().sum() / tokens.sum()
-                ).item()
-                xent_unsmoothed = xent_criterion(
-                    pred.view(-1, pred.size(-1)), gls.view(-1)
-                )
-                summary_writer.add_scalar("defmod-train/xent_smooth", loss.item(), step)
-                summary_writer.add_scalar("defmod-train/xent", xent_unsmoothed, step)
-                summary_writer.add_scalar("defmod-train/acc", acc, step)
+            # keep track of the train loss for this step, without waiting for the device
+            train_metrics.add(step, xent_smooth=loss, xent=xent_unsmoothed, acc=acc)
             pbar.update(vec.size(0))
         if grad_remains:
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
             scheduler.step()
             optimizer.zero_grad()
         pbar.close()
+        train_metrics.flush(step)
+        summary_writer.add_scalar(
+            "defmod-train/padding_efficiency",
+            train_dataloader.sampler.padding_efficiency,
+            epoch,
+        )
+        summary_writer.add_scalar(
+            "defmod-train/loader_stall_time", train_batches.stall_time, epoch
+        )
+        logger.debug(
+            f"Epoch {epoch}, waited {train_batches.stall_time:.2f}s for training batches"
+        )
         ## eval loop
         model.eval()
         with torch.no_grad():
             sum_dev_loss = 0.0
+            # dev loss in mixed precision, checked against the fp32 one
+            sum_mixed_dev_loss = 0.0
             sum_acc = 0
             ntoks = 0
             pbar = tqdm.tqdm(
@@ -312,10 +411,10 @@ def train(
             for batch in dev_dataloader:
                 # JZ --start--
                 # vec = batch[vec_tensor_key].to(device)
-                vec = torch.cat([batch[key].to(device) for key in vec_tensor_key], dim=-1)
+                vec = batch["source_tensor"].to(device, non_blocking=True)
                 # JZ  --end--
                 
-                gls = batch["gloss_tensor"].to(device)
+                gls = batch["gloss_tensor"].to(device, non_blocking=True)
                 pred = model(vec, gls[:-1])
                 sum_dev_loss += F.cross_entropy(
                     pred.view(-1, pred.size(-1)),
@@ -323,6 +422,15 @@ def train(
                     reduction="sum",
                     ignore_index=model.padding_idx,
                 ).item()
+                if precision != "fp32":
+                    with train_utils.autocast(device, precision):
+                        mixed_pred = model(vec, gls[:-1]).float()
+                    sum_mixed_dev_loss += F.cross_entropy(
+                        mixed_pred.view(-1, mixed_pred.size(-1)),
+                        gls.view(-1),
+                        reduction="sum",
+                        ignore_index=model.padding_idx,
+                    ).item()
                 tokens = gls != model.padding_idx
                 ntoks += tokens.sum().item()
                 sum_acc += ((pred.argmax(-1) == gls) & tokens).sum().item()
@@ -332,6 +440,14 @@ def train(
             new_xent = sum_dev_loss / ntoks
             summary_writer.add_scalar("defmod-dev/xent", new_xent, epoch)
             summary_writer.add_scalar("defmod-dev/acc", sum_acc / ntoks, epoch)
+            if precision != "fp32":
+                mixed_xent = sum_mixed_dev_loss / ntoks
+                summary_writer.add_scalar(f"defmod-dev/xent_{precision}", mixed_xent, epoch)
+                if not train_utils.within_tolerance(mixed_xent, new_xent, precision_tolerance):
+                    logger.warning(
+                        f"Epoch {epoch}, {precision} dev loss {mixed_xent:.4f} differs from"
+                        + f" fp32 dev loss {new_xent:.4f} by more than {precision_tolerance:.1%}"
+                    )
             pbar.close()
             if new_xent < (best_xent * 0.999):
                 logger.debug(
@@ -365,11 +481,31 @@ def train(
                 with open(save_dir / "best_scores.txt", "w") as score_file:
                     print(new_xent, file=score_file)
 
+        if checkpoint_every and (epoch + 1) % checkpoint_every == 0:
+            checkpoints.save(
+                epoch,
+                {
+                    "epoch": epoch,
+                    "model": model.state_dict(),
+                    "optimizer": optimizer.state_dict(),
+                    "scheduler": scheduler.state_dict(),
+                    "scaler": scaler.state_dict(),
+                    "best_xent": best_xent,
+                    "strikes": strikes,
+                    "train_step": step + 1,
+                    "rng": train_utils.get_rng_states(),
+                },
+            )
+        if epoch_callback is not None and epoch_callback(epoch, new_xent):
+            logger.debug("Stopping unpromising trial.")
+            epochs_range.close()
+            break
         if strikes >= patience:
             logger.debug("Stopping early.")
             epochs_range.close()
             break
         model.train()
+    checkpoints.wait()
     # return loss for gp minimize
     return best_xent
 
@@ -378,35 +514,55 @@ def pred(args):
     assert args.test_file is not None, "Missing dataset for test"
     # 1. retrieve vocab, dataset, model
     model = models_concat.DefmodModel.load(args.save_dir / "model.pt")
-    train_vocab = data.JSONDataset.load(args.save_dir / "train_dataset.pt").vocab
+    # converts the train_dataset.pt saved alongside models by previous versions
+    train_vocab = data.get_train_dataset(
+        args.train_file, args.spm_model_path, args.save_dir, args.num_workers
+    ).vocab
     test_dataset = data.JSONDataset(
-        args.test_file, vocab=train_vocab, freeze_vocab=True, maxlen=model.maxlen, spm_model_name=args.spm_model_path
+        args.test_file,
+        vocab=train_vocab,
+        freeze_vocab=True,
+        maxlen=model.maxlen,
+        spm_model_name=args.spm_model_path,
+        num_workers=args.num_workers,
+    )
+    test_dataloader = data.get_pred_dataloader(
+        test_dataset,
+        batch_size=args.pred_batch_size,
+        archs=args.source_arch,
+        concat_archs=True,
+        **data.get_loader_options(args),
     )
-    test_dataloader = data.get_dataloader(test_dataset, shuffle=False, batch_size=1)
     model.eval()
 
-    # JZ  --start--
-    # vec_tensor_key = f"{args.source_arch}_tensor"
-    vec_tensor_key = [f"{arch}_tensor" for arch in args.source_arch]    
-    # JZ  --end--
-
     if args.source_arch == "electra":
         assert test_dataset.has_electra, "File is not usable for the task"
     else:
         assert test_dataset.has_vecs, "File is not usable for the task"
     # 2. make predictions
     predictions = []
+    n_tokens = 0
+    start_time = time.perf_counter()
     with torch.no_grad():
         pbar = tqdm.tqdm(desc="Pred.", total=len(test_dataset), disable=None)
         for batch in test_dataloader:
             # JZ --start
             # sequence = model.pred(batch[vec_tensor_key].to(args.device), decode_fn=test_dataset.decode, verbose=False)
-            vec = torch.cat([batch[key].to(args.device) for key in vec_tensor_key], dim=-1)
+            vec = batch["source_tensor"].to(args.device, non_blocking=True)
             # print(f"[DEBUG] vec.shape: {vec.shape}, expected: {model.input_projection.in_features}", flush=True)  # JZ 2
             vec = model.input_projection(vec)  # JZ 2 
             # print(f"[DEBUG] vec.shape before prediction: {vec.shape}, expected: {model.d_model}", flush=True)  # JZ 2
 
-            sequence = model.pred(vec, decode_fn=test_dataset.decode, verbose=False)
+            sequence = model.pred(
+                vec,
+                decode_fn=test_dataset.decode,
+                verbose=False,
+                strategy=args.decoding,
+                beam_size=args.beam_size,
+                top_k=args.top_k,
+                top_p=args.top_p,
+            )
+            n_tokens += (sequence != model.padding_idx).sum().item()
             # JZ --end--
 
             for id, gloss in zip(batch["id"], test_dataset.decode(sequence)):
@@ -414,9 +570,15 @@ def pred(args):
             # pbar.update(batch[vec_tensor_key].size(0))  # JZ
             pbar.update(vec.size(0))  # JZ
         pbar.close()
+    elapsed = time.perf_counter() - start_time
+    logger.debug(
+        f"Decoding ({args.decoding}): {n_tokens} tokens in {elapsed:.1f}s, "
+        + f"{n_tokens / elapsed:.1f} tokens/s"
+    )
     # 3. dump predictions
     with open(args.pred_file, "w") as ostr:
         json.dump(predictions, ostr)
+    return n_tokens, elapsed
 
 
 def main(args):
@@ -431,23 +593,47 @@ def main(args):
             args.save_dir,
             args.device,
             args.spm_model_path, #JZ
+            loader_options=data.get_loader_options(args),
+            precision=args.precision,
+            precision_tolerance=args.precision_tolerance,
+            log_every=args.log_every,
+            checkpoint_every=args.checkpoint_every,
+            keep_checkpoints=args.keep_checkpoints,
+            resume=args.resume,
         )
     elif args.do_htune:
         logger.debug("Performing defmod hyperparameter tuning")
         search_space = get_search_space()
 
         source_arch_str = "_".join(args.source_arch)  # JZ
+        # datasets are built and opened once, then shared by all trials
+        context = htune.TrialContext.prepare(
+            args.train_file,
+            args.dev_file,
+            args.spm_model_path,
+            args.save_dir / source_arch_str,
+            args.num_workers,
+        )
+        for dataset in (context.train_dataset, context.dev_dataset):
+            dataset.source_matrix(args.source_arch)
+
+        # each trial saves to its own directory, as train() appends the architecture
+        arch_dir = args.save_dir / source_arch_str
 
-        @skopt.utils.use_named_args(search_space)
-        def gp_train(**hparams):
+        def trial_dir(trial):
+            """directory trial number `trial` saves its model to"""
+            return arch_dir / f"trial_{trial}" / source_arch_str
+
+        def make_trial(trial, hparams):
+            """arguments of train() for trial number `trial`, with hyperparameters `hparams`"""
             logger.debug(f"Hyperparams sampled:\n{pprint.pformat(hparams)}")          
-            best_loss = train(
+            return dict(
                 train_file=args.train_file,
                 dev_file=args.dev_file,
                 source_arch=args.source_arch,
                 # summary_logdir=args.summary_logdir / args.source_arch / secrets.token_urlsafe(8),  # JZ
                 summary_logdir=args.summary_logdir / source_arch_str / secrets.token_urlsafe(8),  # JZ
-                save_dir=args.save_dir,
+                save_dir=trial_dir(trial).parent,
                 device=args.device,
                 spm_model_path=args.spm_model_path,
                 learning_rate=hparams["learning_rate"],
@@ -459,12 +645,20 @@ def main(args):
                 label_smoothing=hparams["label_smoothing"],
                 n_head=2 ** hparams["n_head_pow"],
                 n_layers=hparams["n_layers"],
+                loader_options=data.get_loader_options(args),
+                precision=args.precision,
+                precision_tolerance=args.precision_tolerance,
+                log_every=args.log_every,
+                context=context,
             )
-            return best_loss
 
-        result = skopt.gp_minimize(gp_train, search_space)
+        # trials run in parallel processes, and unpromising ones are stopped early
+        result = htune.search(
+            train, make_trial, search_space, **htune.get_search_options(args)
+        )
         # args.save_dir = args.save_dir / args.source_arch  # JZ
         args.save_dir = args.save_dir / source_arch_str  # JZ
+        htune.promote_best(result, trial_dir, args.save_dir)
         skopt.dump(result, args.save_dir / "results.pkl", store_objective=False)
 
     if args.do_pred:
@@ -85,6 +85,14 @@ def get_parser(
         default=pathlib.Path("defmod-baseline-preds.json"),
         help="where to save predictions",
     )
+    parser.add_argument(
+        "--pred_batch_size",
+        type=int,
+        default=16,
+        help="how many test items to decode at once",
+    )
+    # Arguments to configure background loading of batches
+    data.add_loader_args(parser)
     return parser
 
 
@@ -125,6 +133,7 @@ def train(
     label_smoothing=0.1,
     n_head=4,
     n_layers=4,
+    loader_options=None,
 ):
     assert train_file is not None, "Missing dataset for training"
     assert dev_file is not None, "Missing dataset for development"
@@ -133,10 +142,14 @@ def train(
     logger.debug("Preloading data")
     save_dir = save_dir / source_arch
     save_dir.mkdir(parents=True, exist_ok=True)
+    loader_options = loader_options or {}
+    num_workers = loader_options.get("num_workers", 1)
     ## make datasets
-    train_dataset = data.get_train_dataset(train_file, spm_model_path, save_dir)
+    train_dataset = data.get_train_dataset(
+        train_file, spm_model_path, save_dir, num_workers
+    )
     dev_dataset = data.get_dev_dataset(
-        dev_file, spm_model_path, save_dir, train_dataset
+        dev_file, spm_model_path, save_dir, train_dataset, num_workers
     )
     ## assert they correspond to the task
     assert train_dataset.has_gloss, "Training dataset contains no gloss."
@@ -150,8 +163,12 @@ def train(
     else:
         assert dev_dataset.has_vecs, "Development dataset contains no vector."
     ## make dataloader
-    train_dataloader = data.get_dataloader(train_dataset)
-    dev_dataloader = data.get_dataloader(dev_dataset, shuffle=False)
+    train_dataloader = data.get_dataloader(
+        train_dataset, archs=[source_arch], **loader_options
+    )
+    dev_dataloader = data.get_dataloader(
+        dev_dataset, shuffle=False, archs=[source_arch], **loader_options
+    )
     ## make summary writer
     summary_writer = SummaryWriter(summary_logdir)
     train_step = itertools.count()  # to keep track of the training steps for logging
@@ -230,6 +247,11 @@ def train(
             scheduler.step()
             optimizer.zero_grad()
         pbar.close()
+        summary_writer.add_scalar(
+            "defmod-train/padding_efficiency",
+            train_dataloader.sampler.padding_efficiency,
+            epoch,
+        )
         ## eval loop
         model.eval()
         with torch.no_grad():
@@ -307,11 +329,24 @@ def pred(args):
     assert args.test_file is not None, "Missing dataset for test"
     # 1. retrieve vocab, dataset, model
     model = models.DefmodModel.load(args.save_dir / "model.pt")
-    train_vocab = data.JSONDataset.load(args.save_dir / "train_dataset.pt").vocab
+    # converts the train_dataset.pt saved alongside models by previous versions
+    train_vocab = data.get_train_dataset(
+        args.train_file, args.spm_model_path, args.save_dir, args.num_workers
+    ).vocab
     test_dataset = data.JSONDataset(
-        args.test_file, vocab=train_vocab, freeze_vocab=True, maxlen=model.maxlen, spm_model_name=args.spm_model_path
+        args.test_file,
+        vocab=train_vocab,
+        freeze_vocab=True,
+        maxlen=model.maxlen,
+        spm_model_name=args.spm_model_path,
+        num_workers=args.num_workers,
+    )
+    test_dataloader = data.get_pred_dataloader(
+        test_dataset,
+        batch_size=args.pred_batch_size,
+        archs=[args.source_arch],
+        **data.get_loader_options(args),
     )
-    test_dataloader = data.get_dataloader(test_dataset, shuffle=False, batch_size=1)
     model.eval()
     vec_tensor_key = f"{args.source_arch}_tensor"
     if args.source_arch == "electra":
@@ -345,6 +380,7 @@ def main(args):
             args.save_dir,
             args.device,
             args.spm_model_path, #JZ
+            loader_options=data.get_loader_options(args),
         )
     elif args.do_htune:
         logger.debug("Performing defmod hyperparameter tuning")
@@ -372,6 +408,7 @@ def main(args):
                 label_smoothing=hparams["label_smoothing"],
                 n_head=2 ** hparams["n_head_pow"],
                 n_layers=hparams["n_layers"],
+                loader_options=data.get_loader_options(args),
             )
             return best_loss
 
@@ -0,0 +1,300 @@
+import concurrent.futures
+import functools
+import logging
+import multiprocessing
+import os
+import pathlib
+import shutil
+import statistics
+import time
+
+import skopt
+
+import torch
+
+import tqdm
+
+import data
+
+logger = logging.getLogger(pathlib.Path(__file__).name)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(tqdm.tqdm)
+handler.terminator = ""
+handler.setFormatter(
+    logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+)
+logger.addHandler(handler)
+
+PRUNERS = ("none", "median", "halving")
+
+
+def add_htune_args(parser):
+    """add arguments configuring hyperparameter search to `parser`"""
+    parser.add_argument(
+        "--htune_calls",
+        type=int,
+        default=100,
+        help="number of trials run during hyperparameter search",
+    )
+    parser.add_argument(
+        "--htune_workers",
+        type=int,
+        default=1,
+        help="number of trials run in parallel, each in its own process",
+    )
+    parser.add_argument(
+        "--cores_per_trial",
+        type=int,
+        default=None,
+        help="number of CPU cores each trial is pinned to, defaults to an even split",
+    )
+    parser.add_argument(
+        "--pruning",
+        type=str,
+        default="median",
+        choices=PRUNERS,
+        help="how to stop unpromising trials early, based on their dev loss after each epoch",
+    )
+    parser.add_argument(
+        "--pruning_warmup",
+        type=int,
+        default=5,
+        help="number of epochs before a trial can be pruned",
+    )
+    parser.add_argument(
+        "--halving_rate",
+        type=int,
+        default=3,
+        help="for successive halving, only the best 1 / rate trials pass each rung",
+    )
+    return parser
+
+
+def get_search_options(args):
+    """retrieve the options added by `add_htune_args` from `args`"""
+    return {
+        "n_calls": args.htune_calls,
+        "n_workers": args.htune_workers,
+        "cores_per_trial": args.cores_per_trial,
+        "pruning": args.pruning,
+        "pruning_warmup": args.pruning_warmup,
+        "halving_rate": args.halving_rate,
+    }
+
+
+class TrialContext:
+    """Datasets shared read-only by all trials of a hyperparameter search.
+    Datasets are memory-mapped, so that processes running trials share the same
+    pages of memory rather than copies, and each process opens them only once
+    however many trials it runs."""
+
+    # datasets opened by the current process, by directory
+    _opened = {}
+
+    def __init__(self, train_dir, dev_dir):
+        self.train_dir = pathlib.Path(train_dir)
+        self.dev_dir = pathlib.Path(dev_dir)
+        start = time.perf_counter()
+        self.train_dataset = self._open(self.train_dir)
+        self.dev_dataset = self._open(self.dev_dir)
+        self.load_time = time.perf_counter() - start
+
+    @classmethod
+    def _open(cls, path):
+        if path not in cls._opened:
+            cls._opened[path] = data.PackedDataset.load(path)
+        return cls._opened[path]
+
+    @classmethod
+    def prepare(cls, train_file, dev_file, spm_model_path, save_dir, num_workers=1):
+        """build the datasets in `save_dir` if need be, as train() would, then open them"""
+        save_dir.mkdir(parents=True, exist_ok=True)
+        data.get_dev_dataset(
+            dev_file,
+            spm_model_path,
+            save_dir,
+            data.get_train_dataset(train_file, spm_model_path, save_dir, num_workers),
+            num_workers,
+        )
+        return cls(save_dir / "train_dataset", save_dir / "dev_dataset")
+
+    # only directories are sent to worker processes
+    def __getstate__(self):
+        return {"train_dir": self.train_dir, "dev_dir": self.dev_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state["train_dir"], state["dev_dir"])
+
+
+class Pruner:
+    """Decide whether to stop trials, from the dev losses all trials reported
+    after each epoch. Reports are stored in a dict shared across processes."""
+
+    def __init__(self, history, strategy="median", warmup=5, halving_rate=3):
+        """
+        args: `history` a dict (possibly a multiprocessing proxy) mapping trials to their dev losses
+              `strategy` "median" or "halving"
+              `warmup` the number of epochs before a trial can be pruned
+              `halving_rate` for successive halving, the ratio of trials stopped at each rung
+        """
+        self.history = history
+        self.strategy = strategy
+        self.warmup = warmup
+        self.halving_rate = halving_rate
+
+    def report(self, trial, epoch, loss):
+        """record the dev `loss` of `trial` after `epoch`, and return whether to stop it"""
+        losses = self.history.get(trial, []) + [loss]
+        self.history[trial] = losses
+        if epoch + 1 < self.warmup:
+            return False
+        others = [
+            other_losses
+            for other, other_losses in dict(self.history).items()
+            if other != trial and len(other_losses) > epoch
+        ]
+        if self.strategy == "median":
+            # stop trials whose best loss so far is worse than the median of the
+            # best losses other trials had at the same epoch
+            if not others:
+                return False
+            median = statistics.median(min(other[: epoch + 1]) for other in others)
+            return min(losses) > median
+        # successive halving: trials are compared at rungs, after warmup x rate^k
+        # epochs, and only the best 1 / rate of those reaching a rung go on
+        rung = self.warmup
+        while rung < epoch + 1:
+            rung *= self.halving_rate
+        if rung != epoch + 1:
+            return False
+        rung_losses = sorted(other[epoch] for other in others)
+        n_promoted = -(-(len(rung_losses) + 1) // self.halving_rate)
+        return sum(other_loss < loss for other_loss in rung_losses) >= n_promoted
+
+
+def _pin_worker(core_groups):
+    """run a worker process on its own group of cores"""
+    cores = core_groups.get()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+
+def _ask(optimizer, pending_points):
+    """propose the next point to evaluate, pretending that points still being
+    evaluated scored the best loss seen so far (constant liar), so that parallel
+    trials do not all sample the same point"""
+    if not pending_points:
+        return optimizer.ask()
+    liar = optimizer.copy(random_state=optimizer.rng.randint(0, 2 ** 31 - 1))
+    lie = min(optimizer.yi) if optimizer.yi else 0.0
+    liar.tell(pending_points, [lie] * len(pending_points))
+    return liar.ask()
+
+
+def _run_trial(train_fn, train_kwargs, trial, pruner):
+    epoch_callback = None
+    if pruner is not None:
+        epoch_callback = functools.partial(pruner.report, trial)
+    return train_fn(**train_kwargs, epoch_callback=epoch_callback)
+
+
+def search(
+    train_fn,
+    make_trial,
+    search_space,
+    n_calls=100,
+    n_workers=1,
+    cores_per_trial=None,
+    pruning="median",
+    pruning_warmup=5,
+    halving_rate=3,
+):
+    """Minimize the best dev loss returned by `train_fn`, running up to
+    `n_workers` trials in parallel processes.
+    args: `train_fn` a module-level training function, which accepts an `epoch_callback`
+          `make_trial` a callable mapping a trial number and a dict of hyperparameters
+                       to the arguments of `train_fn`; each trial should save to its own directory
+          `search_space` a list of named skopt dimensions
+          `n_calls` the total number of trials
+          `n_workers` the number of trials run at once
+          `cores_per_trial` the number of cores each worker is pinned to
+          `pruning` one of PRUNERS
+          `pruning_warmup` the number of epochs before trials can be pruned
+          `halving_rate` for successive halving, the ratio of trials stopped at each rung
+    Returns a skopt OptimizeResult, as skopt.gp_minimize, whose `trials` lists
+    the trial number of each of its points.
+    """
+    optimizer = skopt.Optimizer(search_space, base_estimator="GP", acq_func="gp_hedge")
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    cores_per_trial = cores_per_trial or max(1, len(cores) // n_workers)
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager:
+        core_groups = manager.Queue()
+        for worker_idx in range(n_workers):
+            start = (worker_idx * cores_per_trial) % len(cores)
+            core_groups.put((cores + cores)[start : start + cores_per_trial])
+        pruner = None
+        if pruning != "none":
+            pruner = Pruner(
+                manager.dict(), strategy=pruning, warmup=pruning_warmup, halving_rate=halving_rate
+            )
+        with concurrent.futures.ProcessPoolExecutor(
+            n_workers, mp_context=context, initializer=_pin_worker, initargs=(core_groups,)
+        ) as executor:
+            pending = {}
+            trials = []
+
+            def submit(trial):
+                x = _ask(optimizer, [point for _, point in pending.values()])
+                hparams = {dim.name: value for dim, value in zip(search_space, x)}
+                future = executor.submit(
+                    _run_trial, train_fn, make_trial(trial, hparams), trial, pruner
+                )
+                pending[future] = (trial, x)
+
+            n_submitted = 0
+            while n_submitted < min(n_workers, n_calls):
+                submit(n_submitted)
+                n_submitted += 1
+            while pending:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    trial, x = pending.pop(future)
+                    best_loss = future.result()
+                    logger.debug(f"Trial {trial} done, best dev loss: {best_loss:.4f}")
+                    optimizer.tell(x, best_loss)
+                    trials.append(trial)
+                    if n_submitted < n_calls:
+                        submit(n_submitted)
+                        n_submitted += 1
+    result = optimizer.get_result()
+    result.trials = trials
+    return result
+
+
+def promote_best(result, trial_dir, save_dir):
+    """Copy the model of the best trial of a search to `save_dir`, unless the
+    model already there scored better. Trials save to their own directories, so
+    that parallel trials never write to the same files.
+    args: `result` the result of `search`
+          `trial_dir` a callable mapping a trial number to the directory it saved to
+          `save_dir` the directory the best model is copied to
+    """
+    best_dir = trial_dir(result.trials[result.func_vals.argmin()])
+    if not (best_dir / "best_scores.txt").is_file():
+        return
+    with open(best_dir / "best_scores.txt", "r") as score_file:
+        best_loss = float(score_file.read())
+    if (save_dir / "best_scores.txt").is_file():
+        with open(save_dir / "best_scores.txt", "r") as score_file:
+            if float(score_file.read()) <= best_loss:
+                return
+    logger.debug(f"Promoting {best_dir}, best dev loss: {best_loss:.4f}")
+    save_dir.mkdir(parents=True, exist_ok=True)
+    # scores are copied last, so that they never describe a model not yet in place
+    for file_name in ("model.pt", "hparams.json", "best_scores.txt"):
+        shutil.copyfile(best_dir / file_name, save_dir / f".{file_name}.tmp")
+        os.replace(save_dir / f".{file_name}.tmp", save_dir / file_name)
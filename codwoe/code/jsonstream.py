@@ -0,0 +1,67 @@
+import json
+import re
+
+_WHITESPACE = re.compile(r"\s*")
+
+
+def iter_json_array(file, chunk_size=2 ** 20):
+    """Iterate over the items of a file containing a JSON array, one at a time.
+    Only `chunk_size` characters and the item being parsed are held in memory.
+    args: `file` the path to the JSON file
+          `chunk_size` the number of characters read from the file at once
+    """
+    decoder = json.JSONDecoder()
+    with open(file, "r") as istr:
+        buffer, pos = "", 0
+        at_eof = False
+        expected = "["
+        while True:
+            pos = _WHITESPACE.match(buffer, pos).end()
+            if pos == len(buffer):
+                buffer, pos = istr.read(chunk_size), 0
+                if not buffer:
+                    raise ValueError(f'File "{file}": unexpected end of file.')
+                continue
+            char = buffer[pos]
+            if expected == "[":
+                if char != "[":
+                    raise ValueError(f'File "{file}": does not contain a JSON array.')
+                pos += 1
+                expected = "item or end"
+            elif char == "]":
+                if expected == "item":
+                    raise ValueError(f'File "{file}": could not parse an item.')
+                # only whitespace may follow the array
+                pos += 1
+                while True:
+                    pos = _WHITESPACE.match(buffer, pos).end()
+                    if pos < len(buffer):
+                        raise ValueError(f'File "{file}": extra data after the JSON array.')
+                    buffer, pos = istr.read(chunk_size), 0
+                    if not buffer:
+                        return
+            elif expected == "separator":
+                if char != ",":
+                    raise ValueError(f'File "{file}": items must be separated by commas.')
+                pos += 1
+                expected = "item"
+            else:
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                    # a complete item is followed by a separator or the end of the array
+                    after = _WHITESPACE.match(buffer, end).end()
+                    is_complete = after < len(buffer) and buffer[after] in ",]"
+                except json.JSONDecodeError:
+                    end, is_complete = None, False
+                # the item may be cut by the end of the buffer: read more of the
+                # file and parse it again
+                if not is_complete and not at_eof:
+                    chunk = istr.read(chunk_size)
+                    at_eof = not chunk
+                    buffer, pos = buffer[pos:] + chunk, 0
+                    continue
+                if end is None:
+                    raise ValueError(f'File "{file}": could not parse an item.')
+                pos = end
+                expected = "separator"
+                yield item
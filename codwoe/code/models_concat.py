@@ -3,9 +3,13 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
 
 import data
 
+# the strategies DefmodModel.pred can use to produce glosses
+DECODING_STRATEGIES = ("beam", "greedy", "top_k", "nucleus")
+
 
 def get_schedule(
     optimizer, num_warmup_steps, num_training_steps, num_cycles=0.5, last_epoch=-1
@@ -42,8 +46,8 @@ class PositionalEncoding(nn.Module):
         self.register_buffer("pe", pe)
 
 
-    def forward(self, x):
-        x = x + self.pe[: x.size(0)]
+    def forward(self, x, offset=0):
+        x = x + self.pe[offset : offset + x.size(0)]
         return self.dropout(x)
 
 
@@ -77,6 +81,12 @@ class DefmodModel(nn.Module):
             encoder_layer, num_layers=n_layers
         )
         self.v_proj = nn.Linear(d_model, len(vocab))
+        # causal mask, sliced for each sequence length
+        self.register_buffer(
+            "causal_mask",
+            self.generate_square_subsequent_mask(maxlen + 1),
+            persistent=False,
+        )
         # initializing weights
         for name, param in self.named_parameters():
             if param.dim() > 1:
@@ -86,18 +96,23 @@ class DefmodModel(nn.Module):
             else:  # gain parameters of the layer norm
                 nn.init.ones_(param)
 
-    def generate_square_subsequent_mask(self, sz):
+    def generate_square_subsequent_mask(self, sz, device=None):
         "from Pytorch"
-        mask = (torch.triu(torch.ones(sz, sz)) == 1).transpose(0, 1)
-        mask = (
-            mask.float()
-            .masked_fill(mask == 0, float("-inf"))
-            .masked_fill(mask == 1, float(0.0))
-        )
-        return mask
+        return torch.full((sz, sz), float("-inf"), device=device).triu(1)
+
+    def get_causal_mask(self, sz):
+        """the causal mask for `sz` positions, sliced from a mask built once"""
+        causal_mask = getattr(self, "causal_mask", None)
+        # models saved by previous versions have no cached mask
+        if causal_mask is None or causal_mask.size(0) < sz:
+            device = next(self.parameters()).device
+            causal_mask = self.generate_square_subsequent_mask(
+                max(sz, self.maxlen + 1), device=device
+            )
+            self.register_buffer("causal_mask", causal_mask, persistent=False)
+        return causal_mask[:sz, :sz]
 
     def forward(self, vector, input_sequence=None):
-        device = next(self.parameters()).device
 
         # JZ --start--
         vector = self.input_projection(vector)  # Project concatenated embeddings to match model dimensions
@@ -106,11 +121,12 @@ class DefmodModel(nn.Module):
         embs = self.embedding(input_sequence)
         seq = torch.cat([vector.unsqueeze(0), embs], dim=0)
         src = self.positional_encoding(seq)
-        src_mask = self.generate_square_subsequent_mask(src.size(0)).to(device)
+        src_mask = self.get_causal_mask(src.size(0))
+        src_key_padding_mask = input_sequence == self.padding_idx
         src_key_padding_mask = torch.cat(
             [
-                torch.tensor([[False] * input_sequence.size(1)]).to(device),
-                (input_sequence == self.padding_idx),
+                src_key_padding_mask.new_zeros(1, input_sequence.size(1)),
+                src_key_padding_mask,
             ],
             dim=0,
         ).t()
@@ -128,8 +144,50 @@ class DefmodModel(nn.Module):
         file.parent.mkdir(exist_ok=True, parents=True)
         torch.save(self, file)
 
+    def encode_step(self, src, cache):
+        """Run the newest position of each sequence through the encoder.
+        args: `src` the (positionally encoded) input for the newest position, of shape [Batch x d_model]
+              `cache` a list with one (keys, values) pair per layer for the previous positions (None before the first step)
+        Updates `cache` in place, so that it also covers the newest position.
+        """
+        x = src
+        for layer_idx, layer in enumerate(self.transformer_encoder.layers):
+            attn = layer.self_attn
+            head_dim = self.d_model // attn.num_heads
+            q, k, v = F.linear(x, attn.in_proj_weight, attn.in_proj_bias).chunk(3, dim=-1)
+            q = q.view(-1, attn.num_heads, 1, head_dim) * (head_dim ** -0.5)
+            k = k.view(-1, attn.num_heads, 1, head_dim)
+            v = v.view(-1, attn.num_heads, 1, head_dim)
+            if cache[layer_idx] is not None:
+                k = torch.cat([cache[layer_idx][0], k], dim=2)
+                v = torch.cat([cache[layer_idx][1], v], dim=2)
+            cache[layer_idx] = (k, v)
+            # the newest position may attend to all previous ones, so no mask is needed
+            attn_weights = F.softmax(q @ k.transpose(-2, -1), dim=-1)
+            attn_output = attn.out_proj((attn_weights @ v).view(-1, self.d_model))
+            x = layer.norm1(x + layer.dropout1(attn_output))
+            ff_output = layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))
+            x = layer.norm2(x + layer.dropout2(ff_output))
+        if self.transformer_encoder.norm is not None:
+            x = self.transformer_encoder.norm(x)
+        return x
+
     @torch.no_grad()
-    def pred(self, vector, decode_fn=None, beam_size=64, verbose=False):
+    def pred(
+        self, vector, decode_fn=None, beam_size=64, verbose=False, use_cache=True,
+        strategy="beam", top_k=50, top_p=0.9,
+    ):
+        """Produce a gloss for each batched vector, as a tensor of shape [Sequence x Batch].
+        args: `strategy` one of DECODING_STRATEGIES; all but "beam" produce a single sequence per vector
+              `beam_size` the number of beams kept during beam search
+              `top_k` the number of most likely tokens to sample from, for "top_k" sampling
+              `top_p` the probability mass of most likely tokens to sample from, for "nucleus" sampling
+        """
+        if strategy != "beam":
+            output_sequence = self.sample(vector, strategy=strategy, top_k=top_k, top_p=top_p)
+            if verbose: print(decode_fn(output_sequence))
+            return output_sequence
+
         # which device we should cast our variables to
         device = next(self.parameters()).device
 
@@ -149,22 +207,37 @@ class DefmodModel(nn.Module):
         # the input to kick-start the generation is the embedding, we start with the same input for each beam
         vector_src = vector.unsqueeze(1).expand(batch_size, current_beam_size, -1).reshape(1,  batch_size * current_beam_size, -1)
         src = vector_src
-        src_key_padding_mask = torch.tensor([[False] * (batch_size * current_beam_size)]).to(device)
+        # once every beam is live, each batched example repeats its embedding once per beam
+        vector_src = vector.unsqueeze(1).expand(batch_size, beam_size, -1).reshape(1, batch_size * beam_size, -1)
+        src_key_padding_mask = torch.zeros(1, batch_size * current_beam_size, dtype=torch.bool, device=device)
 
         # variables needed to compute the score of each beam (geometric mean of probability of emission)
         logprobs = torch.zeros(batch_size, current_beam_size, dtype=torch.double).to(device)
         lengths = torch.zeros(batch_size * current_beam_size, dtype=torch.int).to(device)
+        # when decoding incrementally, keys and values of previous positions for each layer
+        cache = [None] * len(self.transformer_encoder.layers)
+        # when decoding incrementally, finished examples leave the batch: we keep track of
+        # which examples are still being decoded, and of the sequences selected for the others
+        example_idx = torch.arange(batch_size, device=device)
+        selected_sequences = [None] * batch_size
         # generate tokens step by step
         for step_idx in range(self.maxlen):
 
-            # generation mask
-            src_mask = self.generate_square_subsequent_mask(src.size(0)).to(device)
-            # positional encoding
-            src_pe = self.positional_encoding(src)
-            # transformer output
-            transformer_output = self.transformer_encoder(
-                src_pe, mask=src_mask, src_key_padding_mask=src_key_padding_mask.t()
-            )[-1]
+            # beams that have stopped don't need to go through the encoder, as their outputs are ignored
+            is_live = ~has_stopped
+            if use_cache:
+                # only the newest position of live beams goes through the encoder: previous ones are cached
+                src_pe = self.positional_encoding(src[-1:], offset=step_idx)
+                transformer_output = self.encode_step(src_pe[0], cache)
+            else:
+                # generation mask
+                src_mask = self.get_causal_mask(src.size(0))
+                # positional encoding
+                src_pe = self.positional_encoding(src)
+                # transformer output
+                transformer_output = self.transformer_encoder(
+                    src_pe, mask=src_mask, src_key_padding_mask=src_key_padding_mask.t()
+                )[-1]
             # distribution over the full vocabulary
             v_dist = self.v_proj(transformer_output)
             # don't generate padding tokens
@@ -173,6 +246,13 @@ class DefmodModel(nn.Module):
 
             # for each beam, select the best candidate continuations
             new_logprobs, new_symbols = v_dist.topk(beam_size, dim=-1)
+            if use_cache:
+                # put back the continuations of live beams among those of all beams
+                live_logprobs, live_symbols = new_logprobs, new_symbols
+                new_logprobs = live_logprobs.new_zeros(is_live.size(0), beam_size)
+                new_logprobs[is_live] = live_logprobs
+                new_symbols = live_symbols.new_full((is_live.size(0), beam_size), self.padding_idx)
+                new_symbols[is_live] = live_symbols
             # patch the output scores to zero-out items that have already stopped
             new_logprobs = new_logprobs.masked_fill(has_stopped.unsqueeze(-1), 0.0)
             # if the beam hasn't stopped, then it needs to produce at least an EOS
@@ -188,6 +268,9 @@ class DefmodModel(nn.Module):
             avg_logprobs = logprobs_ #/ lengths.unsqueeze(-1)
             ## select the `beam_size` best continuations overall, their matching scores will be `avg_logprobs`
             avg_logprobs, selected_beams = avg_logprobs.view(batch_size, current_beam_size * beam_size).topk(beam_size, dim=-1)
+            ## batched examples whose beams have all stopped keep their beams as they are, as if we had stopped decoding them
+            example_done = has_stopped.view(batch_size, current_beam_size).all(-1, keepdim=True)
+            selected_beams = torch.where(example_done, torch.arange(0, current_beam_size * beam_size, beam_size, device=device), selected_beams)
             ## select back the base score for the selected continuations
             logprobs = logprobs_.view(batch_size, current_beam_size * beam_size).gather(-1, selected_beams).view(batch_size, beam_size)
 
@@ -215,16 +298,53 @@ class DefmodModel(nn.Module):
             generated_symbols[-1] = generated_symbols[-1].masked_fill(has_stopped, self.padding_idx)
             has_stopped = has_stopped | (generated_symbols.view(-1, batch_size * beam_size)[-1] == self.eos_idx).view(batch_size * beam_size)
 
-            # recompute padding mask on the basis of which continuations were selected
-            src_key_padding_mask = src_key_padding_mask.view(-1, batch_size, current_beam_size, 1).expand(-1, batch_size, current_beam_size, beam_size)
-            src_key_padding_mask = src_key_padding_mask.reshape(-1, batch_size, current_beam_size * beam_size)
-            src_key_padding_mask = src_key_padding_mask.gather(-1, selected_beams.unsqueeze(0).expand(step_idx + 1, batch_size,  beam_size)).view(step_idx + 1, batch_size * beam_size)
-            src_key_padding_mask = torch.cat([src_key_padding_mask, has_stopped.unsqueeze(0)], dim=0)
-
-            # produce input for the next timestep
-            src = torch.cat([vector_src.expand(1, beam_size, -1), self.embedding(generated_symbols)], dim=0)
-            # reshape to the familiar format
-            generated_symbols = generated_symbols.view(-1, batch_size, beam_size)
+            if use_cache:
+                # an example is done once all of its beams have stopped, or once its best stopped beam scores
+                # higher than all of its live beams: live beams can only lose probability, so at the next
+                # step every beam of the example would be a copy of that stopped beam.
+                beam_has_stopped = has_stopped.view(batch_size, beam_size)
+                best_stopped_logprobs, best_stopped = logprobs.masked_fill(~beam_has_stopped, -float("inf")).max(-1)
+                best_live_logprobs = logprobs.masked_fill(beam_has_stopped, -float("inf")).max(-1)[0]
+                all_stopped = beam_has_stopped.all(-1)
+                is_done = all_stopped | ((best_stopped_logprobs > best_live_logprobs) & (step_idx + 1 < self.maxlen))
+                ## examples whose beams have all stopped select their best beam as usual (see below)
+                best_avg = (logprobs / lengths.view(batch_size, beam_size)).topk(1, dim=1)[1].squeeze(1)
+                best_beam = torch.where(all_stopped, best_avg, best_stopped)
+                ## move the sequences selected for done examples to the results
+                generated_symbols = generated_symbols.view(-1, batch_size, beam_size)
+                for idx in is_done.nonzero().view(-1).tolist():
+                    selected_sequences[example_idx[idx]] = generated_symbols[:, idx, best_beam[idx]]
+
+                # reorder the cache so that it follows the live beams the selected continuations come from
+                ## the cache only holds rows for beams that were live at this step
+                cache_row = is_live.long().cumsum(0) - 1
+                beam_origin = (selected_beams // beam_size) + torch.arange(batch_size, device=device).unsqueeze(1) * current_beam_size
+                ## only beams that are still live, from examples that are not done, will be needed at the next step
+                keep_beams = (~beam_has_stopped & ~is_done.unsqueeze(1)).view(-1)
+                cache_row = cache_row[beam_origin.view(-1)[keep_beams]]
+                cache = [(k.index_select(0, cache_row), v.index_select(0, cache_row)) for k, v in cache]
+                # produce input for the next timestep: only the newest symbols of live beams are needed
+                src = self.embedding(generated_symbols[-1].view(-1)[keep_beams]).unsqueeze(0)
+
+                # drop done examples from the batch
+                keep_examples = ~is_done
+                generated_symbols = generated_symbols[:, keep_examples]
+                logprobs = logprobs[keep_examples]
+                lengths = lengths.view(batch_size, beam_size)[keep_examples].view(-1)
+                has_stopped = beam_has_stopped[keep_examples].view(-1)
+                example_idx = example_idx[keep_examples]
+                batch_size = example_idx.size(0)
+            else:
+                # recompute padding mask on the basis of which continuations were selected
+                src_key_padding_mask = src_key_padding_mask.view(-1, batch_size, current_beam_size, 1).expand(-1, batch_size, current_beam_size, beam_size)
+                src_key_padding_mask = src_key_padding_mask.reshape(-1, batch_size, current_beam_size * beam_size)
+                src_key_padding_mask = src_key_padding_mask.gather(-1, selected_beams.unsqueeze(0).expand(step_idx + 1, batch_size,  beam_size)).view(step_idx + 1, batch_size * beam_size)
+                src_key_padding_mask = torch.cat([src_key_padding_mask, has_stopped.unsqueeze(0)], dim=0)
+
+                # produce input for the next timestep
+                src = torch.cat([vector_src, self.embedding(generated_symbols)], dim=0)
+                # reshape to the familiar format
+                generated_symbols = generated_symbols.view(-1, batch_size, beam_size)
 
             # if all beams have stopped, so do we
             if has_stopped.all():
@@ -232,11 +352,57 @@ class DefmodModel(nn.Module):
             # we update the number of sustained beam at the first iteration, since we know have `beam_size` candidates.
             current_beam_size = beam_size
 
-        # select the most likely sequence for each batched item
+        # select the most likely sequence for each batched item still being decoded
         max_scores, selected_beams = (logprobs / lengths.view(batch_size, beam_size)).topk(1, dim=1)
-        output_sequence = generated_symbols.gather(1, selected_beams.unsqueeze(0).expand(step_idx + 1, batch_size, 1))
-        if verbose: print(decode_fn(output_sequence.squeeze(-1)))
-        return output_sequence.squeeze(-1)
+        output_sequence = generated_symbols.gather(2, selected_beams.unsqueeze(0).expand(generated_symbols.size(0), batch_size, 1))
+        for idx, sequence in zip(example_idx.tolist(), output_sequence.squeeze(-1).unbind(1)):
+            selected_sequences[idx] = sequence
+        output_sequence = pad_sequence(selected_sequences, padding_value=self.padding_idx)
+        if verbose: print(decode_fn(output_sequence))
+        return output_sequence
+
+    @torch.no_grad()
+    def sample(self, vector, strategy="greedy", top_k=50, top_p=0.9):
+        """Produce a single gloss for each batched vector, one token at a time.
+        args: `strategy` "greedy" picks the most likely token, "top_k" and "nucleus" sample one
+              `top_k` the number of most likely tokens to sample from, for "top_k" sampling
+              `top_p` the probability mass of most likely tokens to sample from, for "nucleus" sampling
+        """
+        device = next(self.parameters()).device
+        batch_size = vector.size(0)
+        output_sequence = torch.full((self.maxlen, batch_size), self.padding_idx, dtype=torch.long, device=device)
+        # sequences that produced an EOS leave the batch: keep track of those still being decoded
+        example_idx = torch.arange(batch_size, device=device)
+        cache = [None] * len(self.transformer_encoder.layers)
+        src = vector
+        for step_idx in range(self.maxlen):
+            src_pe = self.positional_encoding(src.unsqueeze(0), offset=step_idx)[0]
+            v_dist = self.v_proj(self.encode_step(src_pe, cache))
+            # don't generate padding tokens
+            v_dist[..., self.padding_idx] = -float("inf")
+            if strategy == "greedy":
+                symbols = v_dist.argmax(-1)
+            elif strategy == "top_k":
+                logits, candidates = v_dist.topk(min(top_k, v_dist.size(-1)), dim=-1)
+                picked = torch.multinomial(F.softmax(logits, dim=-1), 1)
+                symbols = candidates.gather(-1, picked).squeeze(-1)
+            elif strategy == "nucleus":
+                probs, candidates = F.softmax(v_dist, dim=-1).sort(dim=-1, descending=True)
+                # keep the smallest set of most likely tokens whose probability mass reaches `top_p`
+                probs = probs.masked_fill(probs.cumsum(-1) - probs >= top_p, 0.0)
+                picked = torch.multinomial(probs, 1)
+                symbols = candidates.gather(-1, picked).squeeze(-1)
+            else:
+                raise ValueError(f"Unknown decoding strategy: {strategy}")
+            output_sequence[step_idx, example_idx] = symbols
+            # drop sequences that just stopped
+            is_live = symbols != self.eos_idx
+            if not is_live.any():
+                return output_sequence[: step_idx + 1]
+            example_idx = example_idx[is_live]
+            cache = [(k[is_live], v[is_live]) for k, v in cache]
+            src = self.embedding(symbols[is_live])
+        return output_sequence
 
 
 class RevdictModel(nn.Module):
@@ -321,3 +487,74 @@ class LabelSmoothingCrossEntropy(nn.Module):
             log_preds, target, reduction=self.reduction, ignore_index=self.ignore_index
         )
         return linear_combination(loss / n, nll, self.epsilon)
+
+
+class _FusedLabelSmoothingCrossEntropy(torch.autograd.Function):
+    """Label smoothed cross-entropy, cross-entropy and accuracy computed over
+    chunks of rows: log-probabilities are never materialized for all rows at once"""
+
+    @staticmethod
+    def forward(ctx, logits, target, epsilon, ignore_index, chunk_size):
+        n_rows, n_classes = logits.shape
+        is_target = target != ignore_index
+        n_targets = is_target.sum()
+        safe_target = target.masked_fill(~is_target, 0).unsqueeze(-1)
+        lse = torch.empty(n_rows, dtype=logits.dtype, device=logits.device)
+        sum_uniform = logits.new_zeros(())
+        sum_nll = logits.new_zeros(())
+        n_correct = n_targets.new_zeros(())
+        for start in range(0, n_rows, chunk_size):
+            end = start + chunk_size
+            chunk = logits[start:end]
+            chunk_lse = torch.logsumexp(chunk, dim=-1)
+            lse[start:end] = chunk_lse
+            # -sum(log_preds) / n_classes, for each row
+            sum_uniform += (chunk_lse - chunk.mean(dim=-1)).sum()
+            target_logits = chunk.gather(-1, safe_target[start:end]).squeeze(-1)
+            sum_nll += (chunk_lse - target_logits).masked_fill(~is_target[start:end], 0.0).sum()
+            n_correct += ((chunk.argmax(-1) == target[start:end]) & is_target[start:end]).sum()
+        # as in LabelSmoothingCrossEntropy, the uniform term is averaged over all
+        # rows, ignored ones included, while the cross-entropy is averaged over targets
+        nll = sum_nll / n_targets
+        loss = epsilon * sum_uniform / n_rows + (1 - epsilon) * nll
+        acc = n_correct.to(logits.dtype) / n_targets
+        ctx.save_for_backward(logits, safe_target, is_target, lse, n_targets)
+        ctx.epsilon, ctx.chunk_size = epsilon, chunk_size
+        ctx.mark_non_differentiable(nll, acc)
+        return loss, nll, acc
+
+    @staticmethod
+    def backward(ctx, grad_loss, grad_nll, grad_acc):
+        logits, safe_target, is_target, lse, n_targets = ctx.saved_tensors
+        n_rows, n_classes = logits.shape
+        uniform_weight = grad_loss * ctx.epsilon / n_rows
+        target_weight = grad_loss * (1 - ctx.epsilon) / n_targets
+        grad = torch.empty_like(logits)
+        for start in range(0, n_rows, ctx.chunk_size):
+            end = start + ctx.chunk_size
+            probs = (logits[start:end] - lse[start:end].unsqueeze(-1)).exp_()
+            row_target_weight = target_weight * is_target[start:end].to(logits.dtype)
+            row_weight = (uniform_weight + row_target_weight).unsqueeze(-1)
+            chunk_grad = probs.mul_(row_weight).sub_(uniform_weight / n_classes)
+            chunk_grad.scatter_add_(-1, safe_target[start:end], -row_target_weight.unsqueeze(-1))
+            grad[start:end] = chunk_grad
+        return grad, None, None, None, None
+
+
+class FusedLabelSmoothingCrossEntropy(nn.Module):
+    """Equivalent to LabelSmoothingCrossEntropy with a mean reduction, which
+    also returns the unsmoothed cross-entropy and the accuracy over targets.
+    Rows are processed `chunk_size` at a time, in the forward and backward passes."""
+
+    def __init__(self, epsilon: float = 0.1, ignore_index=-100, chunk_size=1024):
+        super().__init__()
+        self.epsilon = epsilon
+        self.ignore_index = ignore_index
+        self.chunk_size = chunk_size
+
+    def forward(self, preds, target):
+        """returns the smoothed loss, the cross-entropy and the accuracy; only the
+        first one can be backpropagated through"""
+        return _FusedLabelSmoothingCrossEntropy.apply(
+            preds, target, self.epsilon, self.ignore_index, self.chunk_size
+        )
@@ -41,8 +41,8 @@ class PositionalEncoding(nn.Module):
         pe = pe.unsqueeze(0).transpose(0, 1)
         self.register_buffer("pe", pe)
 
-    def forward(self, x):
-        x = x + self.pe[: x.size(0)]
+    def forward(self, x, offset=0):
+        x = x + self.pe[offset : offset + x.size(0)]
         return self.dropout(x)
 
 
@@ -69,6 +69,12 @@ class DefmodModel(nn.Module):
             encoder_layer, num_layers=n_layers
         )
         self.v_proj = nn.Linear(d_model, len(vocab))
+        # causal mask, sliced for each sequence length
+        self.register_buffer(
+            "causal_mask",
+            self.generate_square_subsequent_mask(maxlen + 1),
+            persistent=False,
+        )
         # initializing weights
         for name, param in self.named_parameters():
             if param.dim() > 1:
@@ -78,26 +84,32 @@ class DefmodModel(nn.Module):
             else:  # gain parameters of the layer norm
                 nn.init.ones_(param)
 
-    def generate_square_subsequent_mask(self, sz):
+    def generate_square_subsequent_mask(self, sz, device=None):
         "from Pytorch"
-        mask = (torch.triu(torch.ones(sz, sz)) == 1).transpose(0, 1)
-        mask = (
-            mask.float()
-            .masked_fill(mask == 0, float("-inf"))
-            .masked_fill(mask == 1, float(0.0))
-        )
-        return mask
+        return torch.full((sz, sz), float("-inf"), device=device).triu(1)
+
+    def get_causal_mask(self, sz):
+        """the causal mask for `sz` positions, sliced from a mask built once"""
+        causal_mask = getattr(self, "causal_mask", None)
+        # models saved by previous versions have no cached mask
+        if causal_mask is None or causal_mask.size(0) < sz:
+            device = next(self.parameters()).device
+            causal_mask = self.generate_square_subsequent_mask(
+                max(sz, self.maxlen + 1), device=device
+            )
+            self.register_buffer("causal_mask", causal_mask, persistent=False)
+        return causal_mask[:sz, :sz]
 
     def forward(self, vector, input_sequence=None):
-        device = next(self.parameters()).device
         embs = self.embedding(input_sequence)
         seq = torch.cat([vector.unsqueeze(0), embs], dim=0)
         src = self.positional_encoding(seq)
-        src_mask = self.generate_square_subsequent_mask(src.size(0)).to(device)
+        src_mask = self.get_causal_mask(src.size(0))
+        src_key_padding_mask = input_sequence == self.padding_idx
         src_key_padding_mask = torch.cat(
             [
-                torch.tensor([[False] * input_sequence.size(1)]).to(device),
-                (input_sequence == self.padding_idx),
+                src_key_padding_mask.new_zeros(1, input_sequence.size(1)),
+                src_key_padding_mask,
             ],
             dim=0,
         ).t()
@@ -115,8 +127,36 @@ class DefmodModel(nn.Module):
         file.parent.mkdir(exist_ok=True, parents=True)
         torch.save(self, file)
 
+    def encode_step(self, src, cache):
+        """Run the newest position of each sequence through the encoder.
+        args: `src` the (positionally encoded) input for the newest position, of shape [Batch x d_model]
+              `cache` a list with one (keys, values) pair per layer for the previous positions (None before the first step)
+        Updates `cache` in place, so that it also covers the newest position.
+        """
+        x = src
+        for layer_idx, layer in enumerate(self.transformer_encoder.layers):
+            attn = layer.self_attn
+            head_dim = self.d_model // attn.num_heads
+            q, k, v = F.linear(x, attn.in_proj_weight, attn.in_proj_bias).chunk(3, dim=-1)
+            q = q.view(-1, attn.num_heads, 1, head_dim) * (head_dim ** -0.5)
+            k = k.view(-1, attn.num_heads, 1, head_dim)
+            v = v.view(-1, attn.num_heads, 1, head_dim)
+            if cache[layer_idx] is not None:
+                k = torch.cat([cache[layer_idx][0], k], dim=2)
+                v = torch.cat([cache[layer_idx][1], v], dim=2)
+            cache[layer_idx] = (k, v)
+            # the newest position may attend to all previous ones, so no mask is needed
+            attn_weights = F.softmax(q @ k.transpose(-2, -1), dim=-1)
+            attn_output = attn.out_proj((attn_weights @ v).view(-1, self.d_model))
+            x = layer.norm1(x + layer.dropout1(attn_output))
+            ff_output = layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))
+            x = layer.norm2(x + layer.dropout2(ff_output))
+        if self.transformer_encoder.norm is not None:
+            x = self.transformer_encoder.norm(x)
+        return x
+
     @torch.no_grad()
-    def pred(self, vector, decode_fn=None, beam_size=64, verbose=False):
+    def pred(self, vector, decode_fn=None, beam_size=64, verbose=False, use_cache=True):
         # which device we should cast our variables to
         device = next(self.parameters()).device
 
@@ -136,22 +176,31 @@ class DefmodModel(nn.Module):
         # the input to kick-start the generation is the embedding, we start with the same input for each beam
         vector_src = vector.unsqueeze(1).expand(batch_size, current_beam_size, -1).reshape(1,  batch_size * current_beam_size, -1)
         src = vector_src
-        src_key_padding_mask = torch.tensor([[False] * (batch_size * current_beam_size)]).to(device)
+        # once every beam is live, each batched example repeats its embedding once per beam
+        vector_src = vector.unsqueeze(1).expand(batch_size, beam_size, -1).reshape(1, batch_size * beam_size, -1)
+        src_key_padding_mask = torch.zeros(1, batch_size * current_beam_size, dtype=torch.bool, device=device)
 
         # variables needed to compute the score of each beam (geometric mean of probability of emission)
         logprobs = torch.zeros(batch_size, current_beam_size, dtype=torch.double).to(device)
         lengths = torch.zeros(batch_size * current_beam_size, dtype=torch.int).to(device)
+        # when decoding incrementally, keys and values of previous positions for each layer
+        cache = [None] * len(self.transformer_encoder.layers)
         # generate tokens step by step
         for step_idx in range(self.maxlen):
 
-            # generation mask
-            src_mask = self.generate_square_subsequent_mask(src.size(0)).to(device)
-            # positional encoding
-            src_pe = self.positional_encoding(src)
-            # transformer output
-            transformer_output = self.transformer_encoder(
-                src_pe, mask=src_mask, src_key_padding_mask=src_key_padding_mask.t()
-            )[-1]
+            if use_cache:
+                # only the newest position goes through the encoder: previous ones are cached
+                src_pe = self.positional_encoding(src[-1:], offset=step_idx)
+                transformer_output = self.encode_step(src_pe[0], cache)
+            else:
+                # generation mask
+                src_mask = self.get_causal_mask(src.size(0))
+                # positional encoding
+                src_pe = self.positional_encoding(src)
+                # transformer output
+                transformer_output = self.transformer_encoder(
+                    src_pe, mask=src_mask, src_key_padding_mask=src_key_padding_mask.t()
+                )[-1]
             # distribution over the full vocabulary
             v_dist = self.v_proj(transformer_output)
             # don't generate padding tokens
@@ -175,6 +224,9 @@ class DefmodModel(nn.Module):
             avg_logprobs = logprobs_ #/ lengths.unsqueeze(-1)
             ## select the `beam_size` best continuations overall, their matching scores will be `avg_logprobs`
             avg_logprobs, selected_beams = avg_logprobs.view(batch_size, current_beam_size * beam_size).topk(beam_size, dim=-1)
+            ## batched examples whose beams have all stopped keep their beams as they are, as if we had stopped decoding them
+            example_done = has_stopped.view(batch_size, current_beam_size).all(-1, keepdim=True)
+            selected_beams = torch.where(example_done, torch.arange(0, current_beam_size * beam_size, beam_size, device=device), selected_beams)
             ## select back the base score for the selected continuations
             logprobs = logprobs_.view(batch_size, current_beam_size * beam_size).gather(-1, selected_beams).view(batch_size, beam_size)
 
@@ -202,14 +254,21 @@ class DefmodModel(nn.Module):
             generated_symbols[-1] = generated_symbols[-1].masked_fill(has_stopped, self.padding_idx)
             has_stopped = has_stopped | (generated_symbols.view(-1, batch_size * beam_size)[-1] == self.eos_idx).view(batch_size * beam_size)
 
-            # recompute padding mask on the basis of which continuations were selected
-            src_key_padding_mask = src_key_padding_mask.view(-1, batch_size, current_beam_size, 1).expand(-1, batch_size, current_beam_size, beam_size)
-            src_key_padding_mask = src_key_padding_mask.reshape(-1, batch_size, current_beam_size * beam_size)
-            src_key_padding_mask = src_key_padding_mask.gather(-1, selected_beams.unsqueeze(0).expand(step_idx + 1, batch_size,  beam_size)).view(step_idx + 1, batch_size * beam_size)
-            src_key_padding_mask = torch.cat([src_key_padding_mask, has_stopped.unsqueeze(0)], dim=0)
-
-            # produce input for the next timestep
-            src = torch.cat([vector_src.expand(1, beam_size, -1), self.embedding(generated_symbols)], dim=0)
+            if use_cache:
+                # reorder the cache so that it follows the beams the selected continuations come from
+                beam_origin = (selected_beams // beam_size) + torch.arange(batch_size, device=device).unsqueeze(1) * current_beam_size
+                cache = [(k.index_select(0, beam_origin.view(-1)), v.index_select(0, beam_origin.view(-1))) for k, v in cache]
+                # produce input for the next timestep: only the newest symbols are needed
+                src = self.embedding(generated_symbols[-1:])
+            else:
+                # recompute padding mask on the basis of which continuations were selected
+                src_key_padding_mask = src_key_padding_mask.view(-1, batch_size, current_beam_size, 1).expand(-1, batch_size, current_beam_size, beam_size)
+                src_key_padding_mask = src_key_padding_mask.reshape(-1, batch_size, current_beam_size * beam_size)
+                src_key_padding_mask = src_key_padding_mask.gather(-1, selected_beams.unsqueeze(0).expand(step_idx + 1, batch_size,  beam_size)).view(step_idx + 1, batch_size * beam_size)
+                src_key_padding_mask = torch.cat([src_key_padding_mask, has_stopped.unsqueeze(0)], dim=0)
+
+                # produce input for the next timestep
+                src = torch.cat([vector_src, self.embedding(generated_symbols)], dim=0)
             # reshape to the familiar format
             generated_symbols = generated_symbols.view(-1, batch_size, beam_size)
 
@@ -221,7 +280,7 @@ class DefmodModel(nn.Module):
 
         # select the most likely sequence for each batched item
         max_scores, selected_beams = (logprobs / lengths.view(batch_size, beam_size)).topk(1, dim=1)
-        output_sequence = generated_symbols.gather(1, selected_beams.unsqueeze(0).expand(step_idx + 1, batch_size, 1))
+        output_sequence = generated_symbols.gather(2, selected_beams.unsqueeze(0).expand(step_idx + 1, batch_size, 1))
         if verbose: print(decode_fn(output_sequence.squeeze(-1)))
         return output_sequence.squeeze(-1)
 
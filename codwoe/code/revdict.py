@@ -5,6 +5,7 @@ import logging
 import pathlib
 import pprint
 import secrets
+import time
 
 import skopt
 
@@ -17,7 +18,9 @@ from torch.utils.tensorboard import SummaryWriter
 import tqdm
 
 import data
+import htune
 import models
+import train_utils
 
 logger = logging.getLogger(pathlib.Path(__file__).name)
 logger.setLevel(logging.DEBUG)
@@ -87,6 +90,16 @@ def get_parser(
         default=pathlib.Path("revdict-baseline-preds.json"),
         help="where to save predictions",
     )
+    data.add_loader_args(parser)
+    train_utils.add_precision_args(parser)
+    parser.add_argument(
+        "--log_every",
+        type=int,
+        default=50,
+        help="number of training steps metrics are averaged over before being logged",
+    )
+    train_utils.add_checkpoint_args(parser)
+    htune.add_htune_args(parser)
     return parser
 
 
@@ -125,18 +138,35 @@ def train(
     warmup_len=0.1,
     n_head=4,
     n_layers=4,
+    loader_options=None,
+    precision="fp32",
+    precision_tolerance=0.01,
+    log_every=50,
+    checkpoint_every=0,
+    keep_checkpoints=3,
+    resume=False,
+    epoch_callback=None,
+    context=None,
 ):
     assert train_file is not None, "Missing dataset for training"
     assert dev_file is not None, "Missing dataset for development"
+    start_time = time.perf_counter()
     # 1. get data, vocabulary, summary writer
     logger.debug("Preloading data")
     save_dir = save_dir / target_arch
     save_dir.mkdir(parents=True, exist_ok=True)
-    ## make datasets
-    train_dataset = data.get_train_dataset(train_file, spm_model_path, save_dir)
-    dev_dataset = data.get_dev_dataset(
-        dev_file, spm_model_path, save_dir, train_dataset
-    )
+    loader_options = loader_options or {}
+    num_workers = loader_options.get("num_workers", 1)
+    ## make datasets, unless a hyperparameter search shares them across trials
+    if context is None:
+        train_dataset = data.get_train_dataset(
+            train_file, spm_model_path, save_dir, num_workers
+        )
+        dev_dataset = data.get_dev_dataset(
+            dev_file, spm_model_path, save_dir, train_dataset, num_workers
+        )
+    else:
+        train_dataset, dev_dataset = context.train_dataset, context.dev_dataset
 
     ## assert they correspond to the task
     assert train_dataset.has_gloss, "Training dataset contains no gloss."
@@ -150,8 +180,13 @@ def train(
     else:
         assert dev_dataset.has_vecs, "Development dataset contains no vector."
     ## make dataloader
-    train_dataloader = data.get_dataloader(train_dataset)
-    dev_dataloader = data.get_dataloader(dev_dataset, shuffle=False)
+    train_dataloader = data.get_dataloader(
+        train_dataset, archs=[target_arch], **loader_options
+    )
+    dev_dataloader = data.get_dataloader(
+        dev_dataset, shuffle=False, archs=[target_arch], **loader_options
+    )
+    train_batches = data.StallTimer(train_dataloader)
     ## make summary writer
     summary_writer = SummaryWriter(summary_logdir)
     train_step = itertools.count()  # to keep track of the training steps for logging
@@ -174,17 +209,43 @@ def train(
         weight_decay=weight_decay,
     )
     criterion = nn.MSELoss()
+    train_metrics = train_utils.MetricsAccumulator(
+        summary_writer, "revdict-train", log_every=log_every
+    )
 
     vec_tensor_key = f"{target_arch}_tensor"
     best_mse = float("inf")
     strikes = 0
 
     # 4. train model
-    epochs_range = tqdm.trange(epochs, desc="Epochs")
     total_steps = (len(train_dataloader) * epochs) // batch_accum
     scheduler = models.get_schedule(
         optimizer, round(total_steps * warmup_len), total_steps
     )
+    scaler = train_utils.get_grad_scaler(device, precision)
+    ## resume from the full training state of a previous run, if asked to
+    checkpoints = train_utils.CheckpointManager(
+        save_dir / "checkpoints", keep=keep_checkpoints
+    )
+    start_epoch = 0
+    state = checkpoints.load_latest() if resume else None
+    if state is not None:
+        model.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        scheduler.load_state_dict(state["scheduler"])
+        scaler.load_state_dict(state["scaler"])
+        best_mse, strikes = state["best_mse"], state["strikes"]
+        train_step = itertools.count(state["train_step"])
+        train_utils.set_rng_states(state["rng"])
+        start_epoch = state["epoch"] + 1
+        logger.debug(f"Resuming training from the end of epoch {state['epoch']}")
+    epochs_range = tqdm.trange(start_epoch, epochs, desc="Epochs")
+    # time spent before the first step, including opening shared datasets
+    startup_time = time.perf_counter() - start_time
+    if context is not None:
+        startup_time += context.load_time
+    logger.debug(f"Training set up in {startup_time:.2f}s")
+    summary_writer.add_scalar("revdict-train/startup_time", startup_time, start_epoch)
 
     # 4. train model
     for epoch in epochs_range:
@@ -193,38 +254,54 @@ def train(
             desc=f"Train {epoch}", total=len(train_dataset), disable=None, leave=False
         )
         optimizer.zero_grad()
-        for i, batch in enumerate(train_dataloader):
+        for i, batch in enumerate(train_batches):
             optimizer.zero_grad()
-            gls = batch["gloss_tensor"].to(device)
-            vec = batch[vec_tensor_key].to(device)
-            pred = model(gls)
+            gls = batch["gloss_tensor"].to(device, non_blocking=True)
+            vec = batch[vec_tensor_key].to(device, non_blocking=True)
+            with train_utils.autocast(device, precision):
+                pred = model(gls).float()
             loss = criterion(pred, vec)
-            loss.backward()
+            scaler.scale(loss).backward()
             grad_remains = True
             step = next(train_step)
             if i % batch_accum == 0:
-                optimizer.step()
+                scaler.step(optimizer)
+                scaler.update()
                 scheduler.step()
                 optimizer.zero_grad()
                 grad_remains = False
                 summary_writer.add_scalar(
                     "revdict-train/lr", scheduler.get_last_lr()[0], step
                 )
-            # keep track of the train loss for this step
+            # keep track of the train loss for this step, without waiting for the device
             with torch.no_grad():
-                cos_sim = F.cosine_similarity(pred, vec).mean().item()
-                summary_writer.add_scalar("revdict-train/cos", cos_sim, step)
-                summary_writer.add_scalar("revdict-train/mse", loss.item(), step)
+                cos_sim = F.cosine_similarity(pred, vec).mean()
+                train_metrics.add(step, cos=cos_sim, mse=loss)
             pbar.update(vec.size(0))
         if grad_remains:
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
             scheduler.step()
             optimizer.zero_grad()
         pbar.close()
+        train_metrics.flush(step)
+        summary_writer.add_scalar(
+            "revdict-train/padding_efficiency",
+            train_dataloader.sampler.padding_efficiency,
+            epoch,
+        )
+        summary_writer.add_scalar(
+            "revdict-train/loader_stall_time", train_batches.stall_time, epoch
+        )
+        logger.debug(
+            f"Epoch {epoch}, waited {train_batches.stall_time:.2f}s for training batches"
+        )
         ## eval loop
         model.eval()
         with torch.no_grad():
             sum_dev_loss = 0.0
+            # dev loss in mixed precision, checked against the fp32 one
+            sum_mixed_dev_loss = 0.0
             sum_cosine = 0.0
             pbar = tqdm.tqdm(
                 desc=f"Eval {epoch}",
@@ -233,12 +310,18 @@ def train(
                 leave=False,
             )
             for batch in dev_dataloader:
-                gls = batch["gloss_tensor"].to(device)
-                vec = batch[vec_tensor_key].to(device)
+                gls = batch["gloss_tensor"].to(device, non_blocking=True)
+                vec = batch[vec_tensor_key].to(device, non_blocking=True)
                 pred = model(gls)
                 sum_dev_loss += (
                     F.mse_loss(pred, vec, reduction="none").mean(1).sum().item()
                 )
+                if precision != "fp32":
+                    with train_utils.autocast(device, precision):
+                        mixed_pred = model(gls).float()
+                    sum_mixed_dev_loss += (
+                        F.mse_loss(mixed_pred, vec, reduction="none").mean(1).sum().item()
+                    )
                 sum_cosine += F.cosine_similarity(pred, vec).sum().item()
                 pbar.update(vec.size(0))
             # keep track of the average loss on dev set for this epoch
@@ -247,6 +330,14 @@ def train(
                 "revdict-dev/cos", sum_cosine / len(dev_dataset), epoch
             )
             summary_writer.add_scalar("revdict-dev/mse", new_mse, epoch)
+            if precision != "fp32":
+                mixed_mse = sum_mixed_dev_loss / len(dev_dataset)
+                summary_writer.add_scalar(f"revdict-dev/mse_{precision}", mixed_mse, epoch)
+                if not train_utils.within_tolerance(mixed_mse, new_mse, precision_tolerance):
+                    logger.warning(
+                        f"Epoch {epoch}, {precision} dev loss {mixed_mse:.4f} differs from"
+                        + f" fp32 dev loss {new_mse:.4f} by more than {precision_tolerance:.1%}"
+                    )
             pbar.close()
             if new_mse < (best_mse * 0.999):
                 logger.debug(
@@ -279,11 +370,31 @@ def train(
                     json.dump(hparams, json_file, indent=2)
                 with open(save_dir / "best_scores.txt", "w") as score_file:
                     print(new_mse, file=score_file)
+        if checkpoint_every and (epoch + 1) % checkpoint_every == 0:
+            checkpoints.save(
+                epoch,
+                {
+                    "epoch": epoch,
+                    "model": model.state_dict(),
+                    "optimizer": optimizer.state_dict(),
+                    "scheduler": scheduler.state_dict(),
+                    "scaler": scaler.state_dict(),
+                    "best_mse": best_mse,
+                    "strikes": strikes,
+                    "train_step": step + 1,
+                    "rng": train_utils.get_rng_states(),
+                },
+            )
+        if epoch_callback is not None and epoch_callback(epoch, new_mse):
+            logger.debug("Stopping unpromising trial.")
+            epochs_range.close()
+            break
         if strikes >= patience:
             logger.debug("Stopping early.")
             epochs_range.close()
             break
         model.train()
+    checkpoints.wait()
     # return loss for gp minimize
     return best_mse
 
@@ -292,11 +403,24 @@ def pred(args):
     assert args.test_file is not None, "Missing dataset for test"
     # 1. retrieve vocab, dataset, model
     model = models.DefmodModel.load(args.save_dir / "model.pt")
-    train_vocab = data.JSONDataset.load(args.save_dir / "train_dataset.pt").vocab
+    # converts the train_dataset.pt saved alongside models by previous versions
+    train_vocab = data.get_train_dataset(
+        args.train_file, args.spm_model_path, args.save_dir, args.num_workers
+    ).vocab
     test_dataset = data.JSONDataset(
-        args.test_file, vocab=train_vocab, freeze_vocab=True, maxlen=model.maxlen
+        args.test_file,
+        vocab=train_vocab,
+        freeze_vocab=True,
+        maxlen=model.maxlen,
+        num_workers=args.num_workers,
+    )
+    test_dataloader = data.get_dataloader(
+        test_dataset,
+        shuffle=False,
+        batch_size=1024,
+        archs=[],
+        **data.get_loader_options(args),
     )
-    test_dataloader = data.get_dataloader(test_dataset, shuffle=False, batch_size=1024)
     model.eval()
     vec_tensor_key = f"{args.target_arch}_tensor"
     assert test_dataset.has_gloss, "File is not usable for the task"
@@ -305,7 +429,7 @@ def pred(args):
     with torch.no_grad():
         pbar = tqdm.tqdm(desc="Pred.", total=len(test_dataset))
         for batch in test_dataloader:
-            vecs = model(batch["gloss_tensor"].to(args.device)).cpu()
+            vecs = model(batch["gloss_tensor"].to(args.device, non_blocking=True)).cpu()
             for id, vec in zip(batch["id"], vecs.unbind()):
                 predictions.append(
                     {"id": id, args.target_arch: vec.view(-1).cpu().tolist()}
@@ -328,22 +452,44 @@ def main(args):
             args.summary_logdir,
             args.save_dir,
             args.device,
+            loader_options=data.get_loader_options(args),
+            precision=args.precision,
+            precision_tolerance=args.precision_tolerance,
+            log_every=args.log_every,
+            checkpoint_every=args.checkpoint_every,
+            keep_checkpoints=args.keep_checkpoints,
+            resume=args.resume,
         )
     elif args.do_htune:
         logger.debug("Performing revdict hyperparameter tuning")
         search_space = get_search_space()
+        # datasets are built and opened once, then shared by all trials
+        context = htune.TrialContext.prepare(
+            args.train_file,
+            args.dev_file,
+            args.spm_model_path,
+            args.save_dir / args.target_arch,
+            args.num_workers,
+        )
+
+        # each trial saves to its own directory, as train() appends the architecture
+        arch_dir = args.save_dir / args.target_arch
 
-        @skopt.utils.use_named_args(search_space)
-        def gp_train(**hparams):
+        def trial_dir(trial):
+            """directory trial number `trial` saves its model to"""
+            return arch_dir / f"trial_{trial}" / args.target_arch
+
+        def make_trial(trial, hparams):
+            """arguments of train() for trial number `trial`, with hyperparameters `hparams`"""
             logger.debug(f"Hyperparams sampled:\n{pprint.pformat(hparams)}")
-            best_loss = train(
+            return dict(
                 train_file=args.train_file,
                 dev_file=args.dev_file,
                 target_arch=args.target_arch,
                 summary_logdir=args.summary_logdir
                 / args.target_arch
                 / secrets.token_urlsafe(8),
-                save_dir=args.save_dir,
+                save_dir=trial_dir(trial).parent,
                 device=args.device,
                 spm_model_path=args.spm_model_path,
                 learning_rate=hparams["learning_rate"],
@@ -354,11 +500,19 @@ def main(args):
                 warmup_len=hparams["warmup_len"],
                 n_head=2 ** hparams["n_head_pow"],
                 n_layers=hparams["n_layers"],
+                loader_options=data.get_loader_options(args),
+                precision=args.precision,
+                precision_tolerance=args.precision_tolerance,
+                log_every=args.log_every,
+                context=context,
             )
-            return best_loss
 
-        result = skopt.gp_minimize(gp_train, search_space)
+        # trials run in parallel processes, and unpromising ones are stopped early
+        result = htune.search(
+            train, make_trial, search_space, **htune.get_search_options(args)
+        )
         args.save_dir = args.save_dir / args.target_arch
+        htune.promote_best(result, trial_dir, args.save_dir)
         skopt.dump(result, args.save_dir / "results.pkl", store_objective=False)
 
     if args.do_pred:
@@ -0,0 +1,346 @@
+import argparse
+import collections
+import json
+import logging
+import pathlib
+import sys
+import time
+
+import numpy as np
+
+import tqdm
+
+import jsonstream
+
+logger = logging.getLogger(pathlib.Path(__file__).name)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(
+    logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+)
+logger.addHandler(handler)
+
+# number of vectors compared to all centroids at once during clustering
+_ROWS_PER_BLOCK = 8192
+
+
+def get_parser(
+    parser=argparse.ArgumentParser(
+        description="look up the words closest to reverse dictionary predictions"
+    ),
+):
+    parser.add_argument(
+        "--do_build", action="store_true", help="whether to build the index"
+    )
+    parser.add_argument(
+        "--do_query",
+        action="store_true",
+        help="whether to look up the closest words of each prediction",
+    )
+    parser.add_argument(
+        "--do_benchmark",
+        action="store_true",
+        help="whether to compare the recall and latency of the index to exact search",
+    )
+    parser.add_argument(
+        "--target_files",
+        type=pathlib.Path,
+        nargs="+",
+        default=[],
+        help="files containing the words and embeddings to index",
+    )
+    parser.add_argument(
+        "--target_arch",
+        type=str,
+        default="sgns",
+        choices=("sgns", "char", "electra"),
+        help="embedding architecture to index",
+    )
+    parser.add_argument(
+        "--index_dir",
+        type=pathlib.Path,
+        default=pathlib.Path("models") / "revdict-index",
+        help="where to save or load the index",
+    )
+    parser.add_argument(
+        "--n_lists",
+        type=int,
+        default=None,
+        help="number of clusters in the index, defaults to the square root of the number of words",
+    )
+    parser.add_argument(
+        "--n_probe",
+        type=int,
+        default=8,
+        help="number of clusters searched for each query",
+    )
+    parser.add_argument(
+        "--top_k", type=int, default=10, help="number of words returned per query"
+    )
+    parser.add_argument(
+        "--pred_file",
+        type=pathlib.Path,
+        default=pathlib.Path("revdict-baseline-preds.json"),
+        help="reverse dictionary predictions to look up",
+    )
+    parser.add_argument(
+        "--output_file",
+        type=pathlib.Path,
+        default=pathlib.Path("revdict-baseline-words.json"),
+        help="where to save the closest words of each prediction",
+    )
+    parser.add_argument(
+        "--probe_values",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8, 16, 32],
+        help="numbers of searched clusters compared by the benchmark",
+    )
+    parser.add_argument(
+        "--benchmark_file",
+        type=pathlib.Path,
+        default=pathlib.Path("benchmarks") / "revdict-index.tsv",
+        help="where to save the recall and latency of each number of searched clusters",
+    )
+    return parser
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _top_k(scores, k):
+    """indices of the `k` highest `scores`, best first"""
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def read_targets(files, arch):
+    """Read the words and `arch` embeddings of the items in `files`. Words
+    defined several times are indexed once, with their mean embedding.
+    Returns a list of words and a matrix of shape [Words x Dim]
+    """
+    sums, counts = {}, collections.Counter()
+    for file in files:
+        for item in jsonstream.iter_json_array(file):
+            vector = np.asarray(item[arch], dtype=np.float64)
+            if item["word"] in sums:
+                sums[item["word"]] += vector
+            else:
+                sums[item["word"]] = vector
+            counts[item["word"]] += 1
+    words = list(sums)
+    vectors = np.stack([sums[word] / counts[word] for word in words]).astype(np.float32)
+    return words, vectors
+
+
+def read_predictions(file, arch):
+    """Read the ids and `arch` embeddings of reverse dictionary predictions"""
+    ids, vectors = [], []
+    for item in jsonstream.iter_json_array(file):
+        ids.append(item["id"])
+        vectors.append(item[arch])
+    return ids, np.asarray(vectors, dtype=np.float32)
+
+
+class IVFIndex:
+    """Inverted file index over word embeddings, for cosine similarity search.
+    Embeddings are grouped into clusters by spherical k-means, and queries
+    are only compared to the embeddings of the clusters with the closest
+    centroids. Once saved, an index is loaded as memory-mapped arrays."""
+
+    def __init__(self, words, vectors, centroids, list_offsets):
+        """
+        args: `words` the word of each row of `vectors`
+              `vectors` unit-norm embeddings, sorted by cluster, of shape [Words x Dim]
+              `centroids` unit-norm cluster centroids, of shape [Clusters x Dim]
+              `list_offsets` where each cluster starts and ends in `vectors`, shape [Clusters + 1]
+        """
+        self.words = words
+        self.vectors = vectors
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+
+    def __len__(self):
+        return len(self.words)
+
+    @classmethod
+    def build(cls, words, vectors, n_lists=None, n_iter=10, seed=0):
+        """Cluster `vectors`, the embeddings of `words`, into `n_lists` clusters"""
+        vectors = _normalize(vectors)
+        n_lists = min(len(vectors), n_lists or max(1, round(len(vectors) ** 0.5)))
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)]
+        for _ in tqdm.trange(n_iter, desc="K-means", disable=None, leave=False):
+            assignments = cls._assign(vectors, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, vectors)
+            # empty clusters restart from a random embedding
+            empty = np.bincount(assignments, minlength=n_lists) == 0
+            sums[empty] = vectors[rng.choice(len(vectors), empty.sum())]
+            centroids = _normalize(sums)
+        assignments = cls._assign(vectors, centroids)
+        order = np.argsort(assignments, kind="stable")
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=n_lists), out=list_offsets[1:])
+        return cls([words[i] for i in order.tolist()], vectors[order], centroids, list_offsets)
+
+    @staticmethod
+    def _assign(vectors, centroids):
+        """the closest centroid of each vector"""
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), _ROWS_PER_BLOCK):
+            block = vectors[start : start + _ROWS_PER_BLOCK]
+            assignments[start : start + _ROWS_PER_BLOCK] = (block @ centroids.T).argmax(-1)
+        return assignments
+
+    def search(self, queries, k=10, n_probe=8):
+        """Find the `k` words closest to each query, searching the `n_probe`
+        clusters closest to it.
+        Returns two arrays of shape [Queries x k]: the row of each word in
+        `self.words` and its cosine with the query. Missing results, when the
+        searched clusters hold fewer than `k` words, have row -1.
+        """
+        queries = _normalize(np.atleast_2d(queries))
+        n_probe = min(n_probe, len(self.centroids))
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        probes = queries @ self.centroids.T
+        for query_idx, query in enumerate(queries):
+            clusters = _top_k(probes[query_idx], n_probe)
+            candidates = np.concatenate(
+                [
+                    np.arange(self.list_offsets[cluster], self.list_offsets[cluster + 1])
+                    for cluster in clusters
+                ]
+            )
+            candidate_scores = self.vectors[candidates] @ query
+            best = _top_k(candidate_scores, k)
+            rows[query_idx, : len(best)] = candidates[best]
+            scores[query_idx, : len(best)] = candidate_scores[best]
+        return rows, scores
+
+    def exact_search(self, queries, k=10):
+        """Find the `k` words closest to each query by comparing it to all words,
+        with the same outputs as `search`"""
+        queries = _normalize(np.atleast_2d(queries))
+        rows = np.empty((len(queries), min(k, len(self))), dtype=np.int64)
+        scores = np.empty(rows.shape, dtype=np.float32)
+        for start in range(0, len(queries), _ROWS_PER_BLOCK):
+            block_scores = queries[start : start + _ROWS_PER_BLOCK] @ self.vectors.T
+            for row, query_scores in enumerate(block_scores, start):
+                rows[row] = _top_k(query_scores, k)
+                scores[row] = query_scores[rows[row]]
+        return rows, scores
+
+    def save(self, path):
+        """Write the index as .npy files in directory `path`"""
+        path = pathlib.Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(path / "vectors.npy", self.vectors)
+        np.save(path / "centroids.npy", self.centroids)
+        np.save(path / "list_offsets.npy", self.list_offsets)
+        # metadata is written last: a directory without it is an incomplete save
+        with open(path / "meta.json", "w") as ostr:
+            json.dump({"words": self.words}, ostr)
+
+    @classmethod
+    def load(cls, path):
+        """Open the index saved in directory `path` as memory-mapped arrays"""
+        path = pathlib.Path(path)
+        with open(path / "meta.json", "r") as istr:
+            meta = json.load(istr)
+        return cls(
+            meta["words"],
+            np.load(path / "vectors.npy", mmap_mode="r"),
+            np.load(path / "centroids.npy"),
+            np.load(path / "list_offsets.npy"),
+        )
+
+
+def benchmark(index, queries, k=10, probe_values=(1, 2, 4, 8, 16, 32)):
+    """Compare the recall@`k` and per-query latency of `index` to exact search,
+    for each number of searched clusters in `probe_values`. Queries are run one
+    at a time, as they would be served.
+    Returns a list of (n_probe, recall, mean ms, p50 ms, p99 ms) tuples, with
+    n_probe 0 for exact search.
+    """
+    exact_rows, _ = index.exact_search(queries, k=k)
+    results = []
+
+    def time_queries(search_fn):
+        latencies, all_rows = [], []
+        for query in queries:
+            start = time.perf_counter()
+            rows, _ = search_fn(query)
+            latencies.append((time.perf_counter() - start) * 1000)
+            all_rows.append(rows[0])
+        return np.asarray(latencies), all_rows
+
+    latencies, _ = time_queries(lambda query: index.exact_search(query, k=k))
+    results.append((0, 1.0, *_latency_stats(latencies)))
+    for n_probe in probe_values:
+        latencies, all_rows = time_queries(
+            lambda query: index.search(query, k=k, n_probe=n_probe)
+        )
+        recall = np.mean(
+            [
+                len(set(rows.tolist()) & set(exact.tolist())) / len(exact)
+                for rows, exact in zip(all_rows, exact_rows)
+            ]
+        )
+        results.append((n_probe, recall, *_latency_stats(latencies)))
+    return results
+
+
+def _latency_stats(latencies):
+    return latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+
+def main(args):
+    if args.do_build:
+        logger.debug(f"Indexing {args.target_arch} embeddings")
+        assert args.target_files, "Missing files to index"
+        words, vectors = read_targets(args.target_files, args.target_arch)
+        index = IVFIndex.build(words, vectors, n_lists=args.n_lists)
+        index.save(args.index_dir / args.target_arch)
+        logger.debug(f"Indexed {len(index)} words in {len(index.centroids)} clusters")
+    if args.do_query:
+        logger.debug("Looking up predictions")
+        index = IVFIndex.load(args.index_dir / args.target_arch)
+        ids, queries = read_predictions(args.pred_file, args.target_arch)
+        rows, scores = index.search(queries, k=args.top_k, n_probe=args.n_probe)
+        lookups = [
+            {
+                "id": id,
+                "words": [index.words[row] for row in word_rows if row >= 0],
+                "scores": [score for row, score in zip(word_rows, word_scores) if row >= 0],
+            }
+            for id, word_rows, word_scores in zip(ids, rows.tolist(), scores.tolist())
+        ]
+        with open(args.output_file, "w") as ostr:
+            json.dump(lookups, ostr)
+    if args.do_benchmark:
+        logger.debug("Benchmarking the index against exact search")
+        index = IVFIndex.load(args.index_dir / args.target_arch)
+        _, queries = read_predictions(args.pred_file, args.target_arch)
+        results = benchmark(index, queries, k=args.top_k, probe_values=args.probe_values)
+        args.benchmark_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.benchmark_file, "w") as ostr:
+            print("n_probe\trecall\tmean_ms\tp50_ms\tp99_ms", file=ostr)
+            for result in results:
+                print("\t".join(map(str, result)), file=ostr)
+        for n_probe, recall, mean_ms, p50_ms, p99_ms in results:
+            logger.debug(
+                f"{n_probe or 'exact'}: recall@{args.top_k} {recall:.3f}, "
+                + f"{mean_ms:.2f}ms mean, {p99_ms:.2f}ms p99"
+            )
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
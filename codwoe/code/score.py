@@ -1,10 +1,14 @@
 import argparse
 import collections
+import concurrent.futures
+import hashlib
 import itertools
 import json
 import logging
+import multiprocessing
 import os
 import pathlib
+import string
 import sys
 
 logger = logging.getLogger(pathlib.Path(__file__).name)
@@ -15,10 +19,12 @@ handler.setFormatter(
 )
 logger.addHandler(handler)
 
-os.environ["MOVERSCORE_MODEL"] = "distilbert-base-multilingual-cased"
+# the encoder used by MoverScore
+MOVERSCORE_MODEL = "distilbert-base-multilingual-cased"
+os.environ["MOVERSCORE_MODEL"] = MOVERSCORE_MODEL
 import moverscore_v2 as mv_sc
+from pyemd import emd_with_flow
 
-from nltk.translate.bleu_score import sentence_bleu as bleu
 from nltk import word_tokenize as tokenize
 
 import numpy as np
@@ -49,92 +55,397 @@ def get_parser(parser=argparse.ArgumentParser(description="score a submission"))
         help="default path to print output",
         default=pathlib.Path("scores.txt"),
     )
+    parser.add_argument(
+        "--mover_batch_size",
+        type=int,
+        default=64,
+        help="number of sentences encoded at once when computing MoverScore",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="number of processes computing BLEU and solving the transport problems of MoverScore",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=pathlib.Path,
+        default=pathlib.Path(".score_cache"),
+        help="where to cache reference tokenizations and embeddings across runs",
+    )
+    parser.add_argument(
+        "--rank_block_size",
+        type=int,
+        default=4096,
+        help="number of predictions ranked at once by rank_cosine, bounding its memory use",
+    )
+    parser.add_argument(
+        "--sweep",
+        action="store_true",
+        help="score a directory with several submissions per language and track, "
+        + "writing one line per submission and metric",
+    )
+    parser.add_argument(
+        "--group_workers",
+        type=int,
+        default=1,
+        help="number of language and track pairs scored in parallel processes, "
+        + "each loading its own copy of the MoverScore encoder",
+    )
     return parser
 
 
-def mover_corpus_score(sys_stream, ref_streams, trace=0):
-    """Adapted from the MoverScore github"""
+def get_reference_cache(cache_dir, reference_file):
+    """directory caching what scoring computes from `reference_file` alone,
+    keyed by the hash of its contents"""
+    digest = hashlib.sha256(pathlib.Path(reference_file).read_bytes()).hexdigest()
+    return pathlib.Path(cache_dir) / digest[:16]
+
+
+_PUNCTUATION = set(string.punctuation)
+
+
+def _mover_score(problem):
+    """solve the transport problem between a reference and a hypothesis, as
+    `mv_sc.word_mover_score` does"""
+    c1, c2, dst = problem
+    _, flow = emd_with_flow(c1, c2, dst)
+    flow = np.array(flow, dtype=np.float32)
+    return 1 - np.sum(flow * dst)
+
+
+class MoverScorer:
+    """Compute the MoverScore of each hypothesis as `mv_sc.word_mover_score`
+    does for a single pair with uniform IDF weights, but encoding sentences in
+    length-sorted batches. Reference embeddings are cached, so that references
+    are encoded only once when scoring several submissions."""
+
+    def __init__(self, batch_size=64, num_workers=1):
+        """
+        args: `batch_size` the number of sentences encoded at once
+              `num_workers` the number of processes solving transport problems
+        """
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        # maps references to their tokens and last layer embeddings
+        self.reference_cache = {}
+        self.device = next(mv_sc.model.parameters()).device
+
+    def save_references(self, path, refs):
+        """write the cached embeddings of `refs` to directory `path`"""
+        path.mkdir(parents=True, exist_ok=True)
+        refs = list(dict.fromkeys(refs))
+        entries = [self.reference_cache[ref] for ref in refs]
+        offsets = np.zeros(len(entries) + 1, dtype=np.int64)
+        np.cumsum([len(tokens) for tokens, _ in entries], out=offsets[1:])
+        np.save(path / "embeddings.npy", torch.cat([embedding for _, embedding in entries]).numpy())
+        np.save(path / "offsets.npy", offsets)
+        # metadata is written last: a directory without it is an incomplete save
+        with open(path / "meta.json", "w") as ostr:
+            json.dump({"sentences": refs, "tokens": [tokens for tokens, _ in entries]}, ostr)
+
+    def load_references(self, path):
+        """cache the embeddings saved in directory `path` by `save_references`,
+        and return whether there were any"""
+        if not (path / "meta.json").is_file():
+            return False
+        with open(path / "meta.json", "r") as istr:
+            meta = json.load(istr)
+        embeddings = np.load(path / "embeddings.npy")
+        offsets = np.load(path / "offsets.npy")
+        for i, (sentence, tokens) in enumerate(zip(meta["sentences"], meta["tokens"])):
+            embedding = torch.from_numpy(embeddings[offsets[i] : offsets[i + 1]])
+            self.reference_cache[sentence] = (tokens, embedding)
+        return True
+
+    def encode(self, sentences, cache, desc="Encode"):
+        """add the tokens and embeddings of `sentences` missing from `cache` to it"""
+        todo = sorted(
+            {sentence for sentence in sentences if sentence not in cache},
+            key=lambda sentence: len(mv_sc.tokenizer.tokenize(sentence)),
+        )
+        idf_dict = collections.defaultdict(lambda: 1.0)
+        pbar = tqdm.tqdm(desc=desc, disable=None, total=len(todo), leave=False)
+        for start in range(0, len(todo), self.batch_size):
+            batch = todo[start : start + self.batch_size]
+            embeddings, _, _, _, tokens = mv_sc.get_bert_embedding(
+                batch, mv_sc.model, mv_sc.tokenizer, idf_dict, device=self.device
+            )
+            embeddings = embeddings[-1].cpu()
+            for i, sentence in enumerate(batch):
+                # padding is dropped: pairs are compared as if encoded alone
+                cache[sentence] = (tokens[i], embeddings[i, : len(tokens[i])].clone())
+            pbar.update(len(batch))
+        pbar.close()
+        return cache
+
+    @staticmethod
+    def _transport_problem(ref, hyp):
+        """masses and distances between the tokens of `ref` and `hyp`"""
+        (ref_tokens, ref_embedding), (hyp_tokens, hyp_embedding) = ref, hyp
+        raw = torch.cat([ref_embedding, hyp_embedding])
+        # subwords and punctuation are ignored
+        ignored = torch.tensor(
+            ["##" in w or w in _PUNCTUATION for w in itertools.chain(ref_tokens, hyp_tokens)],
+            dtype=torch.bool,
+        )
+        raw[ignored] = 0
+        raw.div_(torch.norm(raw, dim=-1).unsqueeze(-1) + 1e-30)
+        dst = mv_sc.batched_cdist_l2(raw[None], raw[None])[0].double().numpy()
+        weights = (~ignored).double().numpy()
+        c1, c2 = np.zeros(len(raw)), np.zeros(len(raw))
+        c1[: len(ref_tokens)] = weights[: len(ref_tokens)]
+        c2[len(ref_tokens) :] = weights[len(ref_tokens) :]
+        c1 = mv_sc._safe_divide(c1, np.sum(c1))
+        c2 = mv_sc._safe_divide(c2, np.sum(c2))
+        return c1, c2, dst
+
+    def score(self, hyps, refs):
+        """the MoverScore of each hypothesis in `hyps` against the reference at
+        the same position in `refs`"""
+        self.encode(refs, self.reference_cache, desc="Encode refs.")
+        hyp_cache = self.encode(hyps, {}, desc="Encode hyps.")
+        problems = (
+            self._transport_problem(self.reference_cache[ref], hyp_cache[hyp])
+            for ref, hyp in zip(refs, hyps)
+        )
+        pbar = tqdm.tqdm(desc="MvSc.", disable=None, total=len(hyps))
+        if self.num_workers > 1:
+            with multiprocessing.Pool(self.num_workers) as pool:
+                scores = []
+                for score in pool.imap(_mover_score, problems, chunksize=64):
+                    scores.append(score)
+                    pbar.update()
+        else:
+            scores = []
+            for problem in problems:
+                scores.append(_mover_score(problem))
+                pbar.update()
+        pbar.close()
+        return scores
+
+
+# maximum n-gram order of BLEU, whose n-gram precisions are weighted uniformly
+BLEU_ORDER = 4
+
+# number of pairs of glosses whose n-gram counts are compared at once
+_BLEU_PAIRS_PER_BLOCK = 2 ** 20
+
+
+def _ngram_counts(tokens, n):
+    return collections.Counter(
+        tuple(tokens[i : i + n]) for i in range(len(tokens) - n + 1)
+    )
+
+
+def _group_bleu(group):
+    """BLEU of every pair of glosses in a lemma group, as
+    `nltk.translate.bleu_score.sentence_bleu([submitted], reference)` without smoothing.
+    Note that the submitted gloss is thus the reference of nltk, and the
+    reference gloss its hypothesis.
+    args: `group` a pair of lists of tokenized glosses, submitted and reference
+    Returns an array of shape [Submitted x Reference]
+    """
+    submitted, references = group
+    sub_lens = np.array([len(gloss) for gloss in submitted])
+    ref_lens = np.array([len(gloss) for gloss in references])
+    log_precisions = []
+    for n in range(1, BLEU_ORDER + 1):
+        # n-grams are counted once per gloss, then compared for all pairs at once
+        sub_counts = [_ngram_counts(gloss, n) for gloss in submitted]
+        ref_counts = [_ngram_counts(gloss, n) for gloss in references]
+        ngram_ids = {}
+        for counts in itertools.chain(sub_counts, ref_counts):
+            for ngram in counts:
+                ngram_ids.setdefault(ngram, len(ngram_ids))
+        sub_matrix = np.zeros((len(submitted), len(ngram_ids)), dtype=np.int32)
+        ref_matrix = np.zeros((len(references), len(ngram_ids)), dtype=np.int32)
+        for matrix, all_counts in ((sub_matrix, sub_counts), (ref_matrix, ref_counts)):
+            for row, counts in enumerate(all_counts):
+                matrix[row, [ngram_ids[ngram] for ngram in counts]] = list(counts.values())
+        # clipped counts: n-grams of the reference gloss, at most as many times
+        # as they appear in the submitted gloss
+        matches = np.zeros((len(submitted), len(references)), dtype=np.int64)
+        block = max(1, _BLEU_PAIRS_PER_BLOCK // max(1, len(references) * len(ngram_ids)))
+        for start in range(0, len(submitted), block):
+            matches[start : start + block] = np.minimum(
+                sub_matrix[start : start + block, None, :], ref_matrix[None, :, :]
+            ).sum(-1)
+        if n == 1:
+            has_unigram_match = matches > 0
+        totals = np.maximum(1, ref_lens - n + 1)[None, :]
+        # without smoothing, null precisions are replaced by the smallest float
+        precisions = np.where(matches > 0, matches / totals, sys.float_info.min)
+        log_precisions.append(np.log(precisions) / BLEU_ORDER)
+    hyp_lens, closest_ref_lens = ref_lens[None, :], sub_lens[:, None]
+    brevity_penalty = np.where(
+        hyp_lens > closest_ref_lens,
+        1.0,
+        np.exp(1 - closest_ref_lens / np.maximum(hyp_lens, 1)),
+    )
+    brevity_penalty = np.where(hyp_lens == 0, 0.0, brevity_penalty)
+    scores = brevity_penalty * np.exp(np.sum(log_precisions, axis=0))
+    return np.where(has_unigram_match, scores, 0.0)
+
+
+def bleu_scores(submissions, references, lemmas, num_workers=1):
+    """Compute sense-level and lemma-level BLEU of each submitted gloss: the
+    lemma-level score is the best score against any reference gloss of the
+    same lemma. Reference glosses are compared to all submissions at once.
+    args: `submissions` for each submission, the tokenized submitted glosses
+          `references` the tokenized reference gloss of each submitted gloss
+          `lemmas` the (word, pos) pair of each submitted gloss
+          `num_workers` the number of processes scoring lemma groups
+    Returns two lists of scores per submission, sense-level and lemma-level
+    """
+    groups = collections.defaultdict(list)
+    for idx, lemma in enumerate(lemmas):
+        groups[lemma].append(idx)
+    groups = list(groups.values())
+    group_glosses = (
+        (
+            [submitted[i] for submitted in submissions for i in group],
+            [references[i] for i in group],
+        )
+        for group in groups
+    )
+    sense_bleu = [[None] * len(references) for _ in submissions]
+    lemma_bleu = [[None] * len(references) for _ in submissions]
+    pbar = tqdm.tqdm(total=len(references), desc="BLEU", disable=None)
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers)
+        all_scores = pool.imap(_group_bleu, group_glosses, chunksize=16)
+    else:
+        pool = None
+        all_scores = map(_group_bleu, group_glosses)
+    for group, scores in zip(groups, all_scores):
+        # rows are the glosses of each submission in turn
+        for submission_idx in range(len(submissions)):
+            for row, idx in enumerate(group):
+                submission_row = submission_idx * len(group) + row
+                sense_bleu[submission_idx][idx] = scores[submission_row, row].item()
+                lemma_bleu[submission_idx][idx] = scores[submission_row].max().item()
+        pbar.update(len(group))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    pbar.close()
+    return sense_bleu, lemma_bleu
+
+
+def mover_corpus_score(sys_stream, ref_streams, trace=0, scorer=None):
+    """Adapted from the MoverScore github. Each hypothesis is scored against
+    the first reference stream, as `mv_sc.word_mover_score` did."""
 
     if isinstance(sys_stream, str):
         sys_stream = [sys_stream]
     if isinstance(ref_streams, str):
         ref_streams = [[ref_streams]]
     fhs = [sys_stream] + ref_streams
-    corpus_score = 0
-    pbar = tqdm.tqdm(desc="MvSc.", disable=None, total=len(sys_stream))
     for lines in itertools.zip_longest(*fhs):
         if None in lines:
             raise EOFError("Source and reference streams have different lengths!")
-        hypo, *refs = lines
-        idf_dict_hyp = collections.defaultdict(lambda: 1.0)
-        idf_dict_ref = collections.defaultdict(lambda: 1.0)
-        corpus_score += mv_sc.word_mover_score(
-            refs,
-            [hypo],
-            idf_dict_ref,
-            idf_dict_hyp,
-            stop_words=[],
-            n_gram=1,
-            remove_subwords=False,
-        )[0]
-        pbar.update()
-    pbar.close()
+    scorer = scorer or MoverScorer()
+    corpus_score = sum(scorer.score(sys_stream, ref_streams[0]))
     corpus_score /= len(sys_stream)
     return corpus_score
 
 
-def eval_defmod(args, summary):
+def _read_sorted(file):
+    with open(file, "r") as fp:
+        return sorted(json.load(fp), key=lambda r: r["id"])
+
+
+def score_defmod_submissions(
+    submission_files,
+    reference_file,
+    mover_scorer=None,
+    cache_dir=None,
+    num_workers=1,
+    mover_batch_size=64,
+):
+    """Score defmod submissions against the same reference file, which is
+    only read, tokenized and encoded once.
+    args: `submission_files` the submissions to score
+          `reference_file` the reference file of their language
+          `mover_scorer` the MoverScorer to use, possibly shared with other calls
+          `cache_dir` where to cache reference tokenizations and embeddings, if anywhere
+          `num_workers` the number of processes computing BLEU and MoverScore
+          `mover_batch_size` the number of sentences encoded at once, unless `mover_scorer` is given
+    Returns a (MoverScore, lemma-level BLEU, sense-level BLEU) tuple per submission
+    """
     # 1. read contents
-    ## define accumulators for lemma-level BLEU and MoverScore
-    reference_lemma_groups = collections.defaultdict(list)
-    all_preds, all_tgts = [], []
-    ## reading data files
-    with open(args.submission_file, "r") as fp:
-        submission = sorted(json.load(fp), key=lambda r: r["id"])
-    with open(args.reference_file, "r") as fp:
-        reference = sorted(json.load(fp), key=lambda r: r["id"])
+    reference = _read_sorted(reference_file)
+    ## retrieve what previous runs computed from the same reference file
+    reference_cache = None
+    cached_tokens = {}
+    if cache_dir is not None:
+        reference_cache = get_reference_cache(cache_dir, reference_file)
+        if (reference_cache / "tokens.json").is_file():
+            with open(reference_cache / "tokens.json", "r") as istr:
+                cached_tokens = json.load(istr)
+    all_tgts = [ref["gloss"] for ref in reference]
+    ref_glosses = [
+        cached_tokens[ref["id"]] if ref["id"] in cached_tokens else tokenize(ref["gloss"])
+        for ref in tqdm.tqdm(reference, desc="Tokenize refs.", disable=None)
+    ]
+    if reference_cache is not None and not cached_tokens:
+        reference_cache.mkdir(parents=True, exist_ok=True)
+        with open(reference_cache / "tokens.json", "w") as ostr:
+            json.dump({ref["id"]: gloss for ref, gloss in zip(reference, ref_glosses)}, ostr)
+    ## define accumulators for MoverScore and BLEU
+    all_preds, sub_glosses = [], []
+    for submission_file in submission_files:
+        submission = _read_sorted(submission_file)
+        assert len(submission) == len(reference), "Missing items in submission!"
+        for sub, ref in zip(submission, reference):
+            assert sub["id"] == ref["id"], "Mismatch in submission and reference files!"
+        all_preds.append([sub["gloss"] for sub in submission])
+        sub_glosses.append(
+            [tokenize(sub["gloss"]) for sub in tqdm.tqdm(submission, desc="Tokenize", disable=None)]
+        )
 
     # 2. compute scores
-    ## compute sense-level BLEU
-    assert len(submission) == len(reference), "Missing items in submission!"
-    id_to_lemma = {}
-    pbar = tqdm.tqdm(total=len(submission), desc="S-BLEU", disable=None)
-    for sub, ref in zip(submission, reference):
-        assert sub["id"] == ref["id"], "Mismatch in submission and reference files!"
-        all_preds.append(sub["gloss"])
-        all_tgts.append(ref["gloss"])
-        sub["gloss"] = tokenize(sub["gloss"])
-        ref["gloss"] = tokenize(ref["gloss"])
-        sub["sense-BLEU"] = bleu([sub["gloss"]], ref["gloss"])
-        reference_lemma_groups[(ref["word"], ref["pos"])].append(ref["gloss"])
-        id_to_lemma[sub["id"]] = (ref["word"], ref["pos"])
-        pbar.update()
-    pbar.close()
-    ## compute lemma-level BLEU
-    for sub in tqdm.tqdm(submission, desc="L-BLEU", disable=None):
-        sub["lemma-BLEU"] = max(
-            bleu([sub["gloss"]], g)
-            for g in reference_lemma_groups[id_to_lemma[sub["id"]]]
+    ## compute sense-level and lemma-level BLEU
+    sense_bleu, lemma_bleu = bleu_scores(
+        sub_glosses,
+        ref_glosses,
+        [(ref["word"], ref["pos"]) for ref in reference],
+        num_workers=num_workers,
+    )
+    ## compute MoverScore, for all submissions at once
+    mover_scorer = mover_scorer or MoverScorer(mover_batch_size, num_workers)
+    is_cached = False
+    if reference_cache is not None:
+        embeddings_cache = reference_cache / MOVERSCORE_MODEL.replace("/", "--")
+        is_cached = mover_scorer.load_references(embeddings_cache)
+    moverscores = mover_scorer.score(
+        list(itertools.chain.from_iterable(all_preds)), all_tgts * len(all_preds)
+    )
+    if reference_cache is not None and not is_cached:
+        mover_scorer.save_references(embeddings_cache, all_tgts)
+    results = []
+    for submission_idx in range(len(submission_files)):
+        start = submission_idx * len(reference)
+        results.append(
+            (
+                sum(moverscores[start : start + len(reference)]) / len(reference),
+                sum(lemma_bleu[submission_idx]) / len(reference),
+                sum(sense_bleu[submission_idx]) / len(reference),
+            )
         )
-    lemma_bleu_average = sum(s["lemma-BLEU"] for s in submission) / len(submission)
-    sense_bleu_average = sum(s["sense-BLEU"] for s in submission) / len(submission)
-    ## compute MoverScore
-    # moverscore_average = np.mean(mv_sc.word_mover_score(
-    #     all_tgts,
-    #     all_preds,
-    #     collections.defaultdict(lambda:1.),
-    #     collections.defaultdict(lambda:1.),
-    #     stop_words=[],
-    #     n_gram=1,
-    #     remove_subwords=False,
-    #     batch_size=1,
-    # ))
-    moverscore_average = mover_corpus_score(all_preds, [all_tgts])
+    return results
+
+
+def eval_defmod(args, summary, mover_scorer=None):
+    (moverscore_average, lemma_bleu_average, sense_bleu_average), = score_defmod_submissions(
+        [args.submission_file],
+        args.reference_file,
+        mover_scorer=mover_scorer or MoverScorer(args.mover_batch_size, args.num_workers),
+        cache_dir=args.cache_dir,
+        num_workers=args.num_workers,
+    )
     # 3. write results.
-    # logger.debug(f"Submission {args.submission_file}, \n\tMvSc.: " + \
-    #     f"{moverscore_average}\n\tL-BLEU: {lemma_bleu_average}\n\tS-BLEU: " + \
-    #     f"{sense_bleu_average}"
-    # )
     with open(args.output_file, "a") as ostr:
         print(f"MoverScore_{summary.lang}:{moverscore_average}", file=ostr)
         print(f"BLEU_lemma_{summary.lang}:{lemma_bleu_average}", file=ostr)
@@ -147,113 +458,194 @@ def eval_defmod(args, summary):
     )
 
 
-def rank_cosine(preds, targets):
-    unique_targets = targets.unique(dim=0)
-    all_assocs = preds @ F.normalize(targets).T
-    unique_assocs = preds @ F.normalize(unique_targets).T
-    refs = torch.diagonal(all_assocs, 0).unsqueeze(1)
-    ranks = (unique_assocs >= refs).sum(1).float().mean().item()
-    return ranks / unique_targets.size(0)
+# smallest number of predictions ranked at once, see rank_cosine
+_MIN_RANK_BLOCK_SIZE = 64
 
 
-def eval_revdict(args, summary):
-    # 1. read contents
-    ## read data files
-    with open(args.submission_file, "r") as fp:
-        submission = sorted(json.load(fp), key=lambda r: r["id"])
-    with open(args.reference_file, "r") as fp:
-        reference = sorted(json.load(fp), key=lambda r: r["id"])
-    vec_archs = sorted(
-        set(submission[0].keys())
-        - {
-            "id",
-            "gloss",
-            "word",
-            "pos",
-            "concrete",
-            "example",
-            "f_rnk",
-            "counts",
-            "polysemous",
-        }
-    )
-    ## define accumulators for rank-cosine
-    all_preds = collections.defaultdict(list)
-    all_refs = collections.defaultdict(list)
-
-    assert len(submission) == len(reference), "Missing items in submission!"
-    ## retrieve vectors
-    for sub, ref in zip(submission, reference):
-        assert sub["id"] == ref["id"], "Mismatch in submission and reference files!"
-        for arch in vec_archs:
-            all_preds[arch].append(sub[arch])
-            all_refs[arch].append(ref[arch])
+def rank_cosine(preds, targets, block_size=4096):
+    """Average rank of each target among all unique targets, by their cosine
+    with the prediction, normalized by the number of unique targets.
+    Predictions are compared to unique targets `block_size` rows at a time, so
+    that memory use is O(block_size x unique targets) rather than O(N^2).
+    """
+    unique_targets, target_ids = targets.unique(dim=0, return_inverse=True)
+    unique_targets = F.normalize(unique_targets)
+    # products of very few rows use other kernels, which round differently: no
+    # block is shorter than _MIN_RANK_BLOCK_SIZE, a short last one is merged
+    # into the previous one
+    block_size = max(block_size, _MIN_RANK_BLOCK_SIZE)
+    starts = list(range(0, preds.size(0), block_size))
+    if len(starts) > 1 and preds.size(0) - starts[-1] < _MIN_RANK_BLOCK_SIZE:
+        starts.pop()
+    ranks = torch.empty(preds.size(0), dtype=torch.long)
+    for start, end in zip(starts, starts[1:] + [preds.size(0)]):
+        unique_assocs = preds[start:end] @ unique_targets.T
+        # the association with the reference is read from the same product, so
+        # that each target is compared to itself exactly
+        refs = unique_assocs.gather(1, target_ids[start:end, None])
+        ranks[start:end] = (unique_assocs >= refs).sum(1)
+    return ranks.float().mean().item() / unique_targets.size(0)
+
 
+def score_revdict_submissions(submission_files, reference_file, rank_block_size=4096):
+    """Score revdict submissions against the same reference file, which is
+    only read once.
+    args: `submission_files` the submissions to score
+          `reference_file` the reference file of their language
+          `rank_block_size` the number of predictions ranked at once
+    Returns a dict per submission, mapping each predicted architecture to its
+    (MSE, cosine, cosine rank) scores
+    """
     torch.autograd.set_grad_enabled(False)
-    all_preds = {arch: torch.tensor(all_preds[arch]) for arch in vec_archs}
-    all_refs = {arch: torch.tensor(all_refs[arch]) for arch in vec_archs}
+    reference = _read_sorted(reference_file)
+    # reference vectors are converted once per architecture
+    all_refs = {}
+    results = []
+    for submission_file in submission_files:
+        # 1. read contents
+        submission = _read_sorted(submission_file)
+        vec_archs = sorted(
+            set(submission[0].keys())
+            - {
+                "id",
+                "gloss",
+                "word",
+                "pos",
+                "concrete",
+                "example",
+                "f_rnk",
+                "counts",
+                "polysemous",
+            }
+        )
+        assert len(submission) == len(reference), "Missing items in submission!"
+        for sub, ref in zip(submission, reference):
+            assert sub["id"] == ref["id"], "Mismatch in submission and reference files!"
+        ## retrieve vectors
+        scores = {}
+        for arch in vec_archs:
+            if arch not in all_refs:
+                all_refs[arch] = torch.tensor([ref[arch] for ref in reference])
+            preds, refs = torch.tensor([sub[arch] for sub in submission]), all_refs[arch]
+            # 2. compute scores
+            scores[arch] = (
+                F.mse_loss(preds, refs).item(),
+                F.cosine_similarity(preds, refs).mean().item(),
+                rank_cosine(preds, refs, block_size=rank_block_size),
+            )
+        results.append(scores)
+    return results
 
-    # 2. compute scores
-    MSE_scores = {
-        arch: F.mse_loss(all_preds[arch], all_refs[arch]).item() for arch in vec_archs
-    }
-    cos_scores = {
-        arch: F.cosine_similarity(all_preds[arch], all_refs[arch]).mean().item()
-        for arch in vec_archs
-    }
-    rnk_scores = {
-        arch: rank_cosine(all_preds[arch], all_refs[arch]) for arch in vec_archs
-    }
+
+def eval_revdict(args, summary):
+    scores, = score_revdict_submissions(
+        [args.submission_file], args.reference_file, rank_block_size=args.rank_block_size
+    )
+    vec_archs = sorted(scores)
     # 3. display results
-    # logger.debug(f"Submission {args.submission_file}, \n\tMSE: " + \
-    #     ", ".join(f"{a}={MSE_scores[a]}" for a in vec_archs) + \
-    #     ", \n\tcosine: " + \
-    #     ", ".join(f"{a}={cos_scores[a]}" for a in vec_archs) + \
-    #     ", \n\tcosine ranks: " + \
-    #     ", ".join(f"{a}={rnk_scores[a]}" for a in vec_archs) + \
-    #     "."
-    # )
-    # all_archs = sorted(set(reference[0].keys()) - {"id", "gloss", "word", "pos"})
     with open(args.output_file, "a") as ostr:
         for arch in vec_archs:
-            print(f"MSE_{summary.lang}_{arch}:{MSE_scores[arch]}", file=ostr)
-            print(f"cos_{summary.lang}_{arch}:{cos_scores[arch]}", file=ostr)
-            print(f"rnk_{summary.lang}_{arch}:{rnk_scores[arch]}", file=ostr)
+            print(f"MSE_{summary.lang}_{arch}:{scores[arch][0]}", file=ostr)
+            print(f"cos_{summary.lang}_{arch}:{scores[arch][1]}", file=ostr)
+            print(f"rnk_{summary.lang}_{arch}:{scores[arch][2]}", file=ostr)
     return (
         args.submission_file,
-        *[MSE_scores.get(a, None) for a in vec_archs],
-        *[cos_scores.get(a, None) for a in vec_archs],
+        *[scores[a][0] for a in vec_archs],
+        *[scores[a][1] for a in vec_archs],
     )
 
 
-def main(args):
-    def do_score(submission_file, summary):
-        args.submission_file = submission_file
-        args.reference_file = (
-            args.reference_files_dir
-            / f"{summary.lang}.test.{summary.track}.complete.json"
+def score_group(args, lang, track, submission_files, mover_scorer=None):
+    """Score all submissions for the same language and track.
+    Returns a list of (metric, score) pairs per submission, named as in the
+    output file.
+    """
+    reference_file = args.reference_files_dir / f"{lang}.test.{track}.complete.json"
+    if track == "revdict":
+        all_scores = score_revdict_submissions(
+            submission_files, reference_file, rank_block_size=args.rank_block_size
         )
-        eval_func = eval_revdict if summary.track == "revdict" else eval_defmod
-        eval_func(args, summary)
+        return [
+            [
+                (f"{metric}_{lang}_{arch}", arch_scores[arch][metric_idx])
+                for arch in sorted(arch_scores)
+                for metric_idx, metric in enumerate(("MSE", "cos", "rnk"))
+            ]
+            for arch_scores in all_scores
+        ]
+    all_scores = score_defmod_submissions(
+        submission_files,
+        reference_file,
+        mover_scorer=mover_scorer or MoverScorer(args.mover_batch_size, args.num_workers),
+        cache_dir=args.cache_dir,
+        num_workers=args.num_workers,
+    )
+    return [
+        [
+            (f"MoverScore_{lang}", moverscore),
+            (f"BLEU_lemma_{lang}", lemma_bleu),
+            (f"BLEU_sense_{lang}", sense_bleu),
+        ]
+        for moverscore, lemma_bleu, sense_bleu in all_scores
+    ]
 
+
+def main(args):
     if args.output_file.is_dir():
         args.output_file = args.output_file / "scores.txt"
     # wipe file if exists
     open(args.output_file, "w").close()
-    if args.submission_path.is_dir():
-        files = list(args.submission_path.glob("*.json"))
-        assert len(files) >= 1, "No data to score!"
-        summaries = [check_output.main(f) for f in files]
+    if not args.submission_path.is_dir():
+        summary = check_output.main(args.submission_path)
+        args.submission_file = args.submission_path
+        args.reference_file = (
+            args.reference_files_dir
+            / f"{summary.lang}.test.{summary.track}.complete.json"
+        )
+        if summary.track == "revdict":
+            eval_revdict(args, summary)
+        else:
+            eval_defmod(args, summary)
+        return
+    files = sorted(args.submission_path.glob("*.json"))
+    assert len(files) >= 1, "No data to score!"
+    summaries = [check_output.main(f) for f in files]
+    if not args.sweep:
         assert len(set(summaries)) == len(files), "Ensure files map to unique setups."
         rd_cfg = [
             (s.lang, a) for s in summaries if s.track == "revdict" for a in s.vec_archs
         ]
         assert len(set(rd_cfg)) == len(rd_cfg), "Ensure files map to unique setups."
-        for summary, submitted_file in zip(summaries, files):
-            do_score(submitted_file, summary)
+    # submissions are grouped by reference file, which is read once per group
+    groups = collections.defaultdict(list)
+    for summary, submitted_file in zip(summaries, files):
+        groups[(summary.lang, summary.track)].append(submitted_file)
+    if args.group_workers > 1:
+        # moverscore_v2 moved its encoder to the GPU when imported, which forked
+        # processes cannot use: workers are spawned, and each loads the encoder
+        with concurrent.futures.ProcessPoolExecutor(
+            args.group_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = [
+                executor.submit(score_group, args, lang, track, group_files)
+                for (lang, track), group_files in groups.items()
+            ]
+            all_scores = [future.result() for future in futures]
     else:
-        summary = check_output.main(args.submission_path)
-        do_score(args.submission_path, summary)
+        # shared by all groups, so that the encoder is loaded once
+        mover_scorer = MoverScorer(args.mover_batch_size, args.num_workers)
+        all_scores = [
+            score_group(args, lang, track, group_files, mover_scorer=mover_scorer)
+            for (lang, track), group_files in groups.items()
+        ]
+    with open(args.output_file, "a") as ostr:
+        for group_files, group_scores in zip(groups.values(), all_scores):
+            for submitted_file, scores in zip(group_files, group_scores):
+                for metric, value in scores:
+                    if args.sweep:
+                        print(f"{submitted_file.name}\t{metric}\t{value}", file=ostr)
+                    else:
+                        print(f"{metric}:{value}", file=ostr)
 
 
 if __name__ == "__main__":
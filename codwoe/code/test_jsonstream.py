@@ -0,0 +1,41 @@
+import json
+import pathlib
+import tempfile
+import unittest
+
+import jsonstream
+
+
+class IterJsonArrayTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def parse(self, text, chunk_size=2):
+        path = pathlib.Path(self.tmp_dir.name) / "file.json"
+        path.write_text(text)
+        return list(jsonstream.iter_json_array(path, chunk_size=chunk_size))
+
+    def test_items_match_json_load(self):
+        text = json.dumps([{"id": "en.1", "gloss": "a [b], c"}, [1.5, -2], "]", None, {}])
+        for chunk_size in (1, 2, 7, 2 ** 20):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self.parse(text, chunk_size), json.loads(text))
+
+    def test_whitespace_around_array(self):
+        self.assertEqual(self.parse(" \n[ 1 ,\t2 ]  \n\n"), [1, 2])
+        self.assertEqual(self.parse("[]"), [])
+
+    def test_trailing_data(self):
+        for text in ("[1]x", "[1] ]", "[1]      []", "[]0"):
+            with self.subTest(text=text), self.assertRaises(ValueError):
+                self.parse(text)
+
+    def test_malformed_arrays(self):
+        for text in ("", "{}", "[1 2]", "[1,]", "[,1]", "[1,"):
+            with self.subTest(text=text), self.assertRaises(ValueError):
+                self.parse(text)
+
+
+if __name__ == "__main__":
+    unittest.main()
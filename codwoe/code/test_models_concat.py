@@ -0,0 +1,85 @@
+import unittest
+
+import torch
+import torch.nn.functional as F
+
+import data
+import models_concat
+
+
+def _strip(sequence):
+    """tokens of `sequence` up to its padding"""
+    return [token for token in sequence.tolist() if token != 0]
+
+
+class DefmodPredTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(3)
+        vocab = {data.PAD: 0, data.EOS: 1, data.BOS: 2, data.UNK: 3}
+        for idx in range(60):
+            vocab[f"w{idx}"] = len(vocab)
+        self.model = models_concat.DefmodModel(
+            vocab, input_dim=16, d_model=32, n_head=4, n_layers=2, maxlen=25
+        ).eval()
+        # sharper distributions and a likely EOS, so that some examples stop
+        # after a token or two while others run to maxlen
+        with torch.no_grad():
+            self.model.v_proj.weight.mul_(2.0)
+            self.model.v_proj.bias[1] = 2.4
+        self.vectors = torch.randn(20, 32) * 2
+
+    def test_cache_matches_full_decoding(self):
+        for beam_size in (1, 3, 8, 16):
+            with self.subTest(beam_size=beam_size):
+                expected = self.model.pred(self.vectors, beam_size=beam_size, use_cache=False)
+                # finished examples leave the batch when decoding with a cache
+                output = self.model.pred(self.vectors, beam_size=beam_size, use_cache=True)
+                expected = [_strip(sequence) for sequence in expected.unbind(1)]
+                self.assertEqual([_strip(sequence) for sequence in output.unbind(1)], expected)
+                lengths = [len(sequence) for sequence in expected]
+                self.assertGreater(max(lengths) - min(lengths), 3)
+
+    def test_batch_matches_single_examples(self):
+        output = self.model.pred(self.vectors, beam_size=8, use_cache=True)
+        for idx in range(self.vectors.size(0)):
+            single = self.model.pred(self.vectors[idx : idx + 1], beam_size=8, use_cache=True)
+            self.assertEqual(_strip(output[:, idx]), _strip(single[:, 0]))
+
+
+class FusedLabelSmoothingCrossEntropyTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        # 8 does not divide the number of rows, so the last chunk is shorter
+        self.logits = torch.randn(37, 23, dtype=torch.double) * 3
+        self.target = torch.randint(0, 23, (37,))
+        self.target[::5] = 0
+        self.criterion = models_concat.FusedLabelSmoothingCrossEntropy(
+            epsilon=0.1, ignore_index=0, chunk_size=8
+        )
+
+    def test_matches_label_smoothing_cross_entropy(self):
+        logits = self.logits.clone().requires_grad_()
+        loss, nll, acc = self.criterion(logits, self.target)
+        loss.backward()
+        expected_logits = self.logits.clone().requires_grad_()
+        expected_loss = models_concat.LabelSmoothingCrossEntropy(epsilon=0.1, ignore_index=0)(
+            expected_logits, self.target
+        )
+        expected_loss.backward()
+        self.assertTrue(torch.allclose(loss, expected_loss))
+        self.assertTrue(torch.allclose(logits.grad, expected_logits.grad))
+        expected_nll = F.cross_entropy(self.logits, self.target, ignore_index=0)
+        self.assertTrue(torch.allclose(nll, expected_nll))
+        is_target = self.target != 0
+        expected_acc = (self.logits.argmax(-1) == self.target)[is_target].double().mean()
+        self.assertTrue(torch.allclose(acc, expected_acc))
+
+    def test_gradcheck(self):
+        logits = self.logits.clone().requires_grad_()
+        self.assertTrue(
+            torch.autograd.gradcheck(lambda logits: self.criterion(logits, self.target)[0], (logits,))
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
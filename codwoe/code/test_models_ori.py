@@ -0,0 +1,42 @@
+import unittest
+
+import torch
+
+import data
+import models_ori
+
+
+def _strip(sequence):
+    """tokens of `sequence` up to its padding"""
+    return [token for token in sequence.tolist() if token != 0]
+
+
+class DefmodPredTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(3)
+        vocab = {data.PAD: 0, data.EOS: 1, data.BOS: 2, data.UNK: 3}
+        for idx in range(60):
+            vocab[f"w{idx}"] = len(vocab)
+        self.model = models_ori.DefmodModel(
+            vocab, d_model=32, n_head=4, n_layers=2, maxlen=25
+        ).eval()
+        # sharper distributions and a likely EOS, so that examples stop at
+        # different steps
+        with torch.no_grad():
+            self.model.v_proj.weight.mul_(2.0)
+            self.model.v_proj.bias[1] = 1.0
+        self.vectors = torch.randn(20, 32) * 2
+
+    def test_cache_matches_full_decoding(self):
+        for beam_size in (1, 3, 8, 16):
+            with self.subTest(beam_size=beam_size):
+                expected = self.model.pred(self.vectors, beam_size=beam_size, use_cache=False)
+                output = self.model.pred(self.vectors, beam_size=beam_size, use_cache=True)
+                expected = [_strip(sequence) for sequence in expected.unbind(1)]
+                self.assertEqual([_strip(sequence) for sequence in output.unbind(1)], expected)
+                lengths = [len(sequence) for sequence in expected]
+                self.assertGreater(max(lengths) - min(lengths), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+import warnings
+
+from nltk.translate.bleu_score import sentence_bleu
+
+import torch
+
+import score
+
+
+class RankCosineTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.targets = torch.randn(1000, 64)
+        # repeated targets share a rank
+        self.targets[500:700] = self.targets[:200]
+        self.preds = self.targets + 4.0 * torch.randn(1000, 64)
+
+    def test_blocks_match_unblocked(self):
+        unblocked = score.rank_cosine(self.preds, self.targets, block_size=1000)
+        # the last blocks are 100, 1 and 10 rows long
+        for block_size in (300, 333, 990):
+            with self.subTest(block_size=block_size):
+                self.assertEqual(
+                    score.rank_cosine(self.preds, self.targets, block_size=block_size),
+                    unblocked,
+                )
+
+    def test_fewer_rows_than_a_block(self):
+        preds, targets = self.preds[:50], self.targets[:50]
+        self.assertEqual(
+            score.rank_cosine(preds, targets, block_size=1),
+            score.rank_cosine(preds, targets, block_size=50),
+        )
+
+
+class BleuScoresTest(unittest.TestCase):
+    def test_matches_nltk(self):
+        # identical glosses, overlapping glosses of different lengths, glosses
+        # shorter than 4 tokens and an empty one
+        glosses = [
+            "a small domesticated carnivorous mammal".split(),
+            "a small domesticated carnivorous mammal with soft fur".split(),
+            "a feline".split(),
+            [],
+            "the act of running quickly on foot".split(),
+            "run".split(),
+            "to move swiftly on foot , run".split(),
+        ]
+        submitted = [
+            "a small domesticated carnivorous mammal".split(),
+            "a small domesticated carnivorous mammal".split(),
+            "a feline animal".split(),
+            "a cat".split(),
+            "the act of running quickly on foot for exercise".split(),
+            "run".split(),
+            "to move swiftly on foot".split(),
+        ]
+        lemmas = [("cat", "n")] * 4 + [("run", "v")] * 3
+        sense_bleu, lemma_bleu = score.bleu_scores([submitted], glosses, lemmas)
+        # as the scorer used to: the submitted gloss is the reference of nltk
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            expected = [
+                [sentence_bleu([sub], ref) for ref in glosses] for sub in submitted
+            ]
+        # scores range over hundreds of orders of magnitude: they are compared relatively
+        for idx, lemma in enumerate(lemmas):
+            with self.subTest(idx=idx):
+                expected_sense = expected[idx][idx]
+                self.assertAlmostEqual(sense_bleu[0][idx], expected_sense, delta=1e-9 * expected_sense)
+                expected_lemma = max(
+                    expected[idx][other] for other in range(len(lemmas)) if lemmas[other] == lemma
+                )
+                self.assertAlmostEqual(lemma_bleu[0][idx], expected_lemma, delta=1e-9 * expected_lemma)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,204 @@
+import concurrent.futures
+import contextlib
+import os
+import pathlib
+import random
+
+import numpy as np
+
+import torch
+
+# the precisions models can be trained in, and the type autocast computes in
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def add_precision_args(parser):
+    """add arguments selecting the training precision to `parser`"""
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=tuple(PRECISIONS),
+        help="train with mixed precision: bf16 is recommended on CPU, fp16 on GPU",
+    )
+    parser.add_argument(
+        "--precision_tolerance",
+        type=float,
+        default=0.01,
+        help="relative difference between mixed precision and fp32 dev losses before warning",
+    )
+    return parser
+
+
+def autocast(device, precision="fp32"):
+    """context in which the forward pass runs in mixed `precision` on `device`"""
+    device_type = torch.device(device).type
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    # torch.autocast appeared in torch 1.10, before which only CUDA fp16 is supported
+    if hasattr(torch, "autocast"):
+        return torch.autocast(device_type=device_type, dtype=PRECISIONS[precision])
+    if device_type == "cuda" and precision == "fp16":
+        return torch.cuda.amp.autocast()
+    raise ValueError(
+        f"{precision} training on {device_type} requires torch >= 1.10, found {torch.__version__}"
+    )
+
+
+def get_grad_scaler(device, precision="fp32"):
+    """scale losses to avoid underflowing gradients: only fp16 has so narrow a range"""
+    device_type = torch.device(device).type
+    # torch.amp.GradScaler appeared in torch 2.3, before which only CUDA is supported
+    if hasattr(torch, "amp") and hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler(device_type, enabled=precision == "fp16")
+    if precision == "fp16" and device_type != "cuda":
+        raise ValueError(
+            f"fp16 training on {device_type} requires torch >= 2.3, found {torch.__version__}"
+        )
+    return torch.cuda.amp.GradScaler(enabled=precision == "fp16")
+
+
+def within_tolerance(value, reference, tolerance):
+    """whether `value` differs from `reference` by at most `tolerance`, relatively"""
+    return abs(value - reference) <= tolerance * abs(reference)
+
+
+class MetricsAccumulator:
+    """Sum training metrics on their device over several steps, so that the
+    host only waits for them when they are logged"""
+
+    def __init__(self, summary_writer, prefix, log_every=1):
+        """
+        args: `summary_writer` the tensorboard SummaryWriter to log metrics to
+              `prefix` the tag prefix of logged metrics, e.g. "defmod-train"
+              `log_every` the number of steps metrics are averaged over
+        """
+        self.summary_writer = summary_writer
+        self.prefix = prefix
+        self.log_every = log_every
+        self.sums = {}
+        self.n_steps = 0
+
+    def add(self, step, **metrics):
+        """record the scalar tensors `metrics` of training step `step`"""
+        for name, value in metrics.items():
+            value = value.detach()
+            self.sums[name] = self.sums[name] + value if name in self.sums else value
+        self.n_steps += 1
+        if self.n_steps >= self.log_every:
+            self.flush(step)
+
+    def flush(self, step):
+        """log the averages of recorded metrics at step `step`"""
+        if not self.n_steps:
+            return
+        # a single transfer to the host for all metrics
+        averages = (torch.stack(list(self.sums.values())).float() / self.n_steps).tolist()
+        for name, average in zip(self.sums, averages):
+            self.summary_writer.add_scalar(f"{self.prefix}/{name}", average, step)
+        self.sums = {}
+        self.n_steps = 0
+
+
+def add_checkpoint_args(parser):
+    """add arguments controlling training checkpoints to `parser`"""
+    parser.add_argument(
+        "--checkpoint_every",
+        type=int,
+        default=0,
+        help="number of epochs between two checkpoints of the full training state, 0 to disable",
+    )
+    parser.add_argument(
+        "--keep_checkpoints",
+        type=int,
+        default=3,
+        help="number of most recent checkpoints kept on disk, 0 to keep them all",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="whether to resume training from the latest checkpoint, see --checkpoint_every",
+    )
+    return parser
+
+
+def get_rng_states():
+    """the states of all random number generators used during training"""
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {
+        "python": random.getstate(),
+        # stored as a tensor, so that checkpoints only contain tensors and builtins
+        "numpy": (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_states(states):
+    """restore random number generators from the output of `get_rng_states`"""
+    name, keys, pos, has_gauss, cached_gaussian = states["numpy"]
+    random.setstate(states["python"])
+    np.random.set_state(
+        (name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian)
+    )
+    torch.set_rng_state(states["torch"])
+    if states["cuda"] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+
+def _copy_to_cpu(obj):
+    """copy all tensors in a nested structure, so that training can modify them while they are written"""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: _copy_to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_copy_to_cpu(value) for value in obj)
+    return obj
+
+
+class CheckpointManager:
+    """Write full training states to `directory` in a background thread, keeping
+    only the `keep` most recent ones, or all of them if `keep` is 0"""
+
+    def __init__(self, directory, keep=3):
+        self.directory = pathlib.Path(directory)
+        self.keep = keep
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+
+    def checkpoints(self):
+        """paths of the checkpoints on disk, oldest first"""
+        return sorted(self.directory.glob("checkpoint-*.pt"))
+
+    def save(self, epoch, state):
+        """copy `state` to CPU memory, then write it to disk without blocking"""
+        state = _copy_to_cpu(state)
+        # the previous checkpoint has had a whole epoch to be written
+        self.wait()
+        self._pending = self._executor.submit(self._write, epoch, state)
+
+    def _write(self, epoch, state):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"checkpoint-{epoch:04d}.pt"
+        # a checkpoint interrupted while being written is never picked up
+        temp_path = path.with_suffix(".tmp")
+        torch.save(state, temp_path)
+        os.replace(temp_path, path)
+        if self.keep > 0:
+            for old_path in self.checkpoints()[: -self.keep]:
+                old_path.unlink()
+
+    def wait(self):
+        """block until pending checkpoints are written, raising their errors if any"""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def load_latest(self):
+        """the most recent training state, or None if there is no checkpoint"""
+        self.wait()
+        checkpoints = self.checkpoints()
+        if not checkpoints:
+            return None
+        return torch.load(checkpoints[-1], map_location="cpu")